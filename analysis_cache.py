@@ -0,0 +1,245 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import threading
+import uuid
+import numpy as np
+
+import mask_analysis
+from settings import ANALYSIS_CACHE_DIRECTORY, ANALYSIS_CACHE_MAX_BYTES, BOX_SIZE, CROP_IMAGE_SIZE
+
+# 저장 형식이나 후처리 방식이 바뀌면 올려서 이전 캐시를 무효화한다
+CACHE_VERSION = 2
+
+# 회귀에 필요한 군집별 값 - 군집 수에 비례하는 크기이므로 예측 마스크와 레이블 이미지 없이 이것만 저장한다
+MOMENT_FIELDS = ["area", "sum_x", "sum_y", "m_xx", "m_yy", "m_xy"]
+
+def image_digest(image: np.ndarray):
+    """이미지 내용(크기, 자료형, 픽셀)의 해시 - ImageSource라면 원본 파일 내용의 해시"""
+
+    if hasattr(image, "digest"):
+        return image.digest()
+
+    image = np.ascontiguousarray(image)
+
+    digest = hashlib.sha1(f"{image.shape}{image.dtype}".encode())
+    digest.update(memoryview(image).cast("B"))
+
+    return digest.hexdigest()
+
+_file_digests = {}
+_file_digests_lock = threading.Lock()
+
+def file_digest(path):
+    """파일 내용의 해시 - 경로, 수정 시각, 크기가 같다면 다시 읽지 않는다"""
+
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    with _file_digests_lock:
+        if key in _file_digests:
+            return _file_digests[key]
+
+    digest = hashlib.sha1()
+
+    if os.path.isdir(path):
+        # SavedModel 디렉토리는 안의 파일을 모두 읽는다
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                digest.update(os.path.relpath(os.path.join(root, file), path).encode())
+                with open(os.path.join(root, file), "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(block)
+    else:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+
+    with _file_digests_lock:
+        _file_digests[key] = digest.hexdigest()
+
+    return _file_digests[key]
+
+def prediction_key(image: np.ndarray, model_path, stride, backend=""):
+    """
+    예측 마스크와 군집 표의 캐시 키 - 이미지 내용, 모델 파일 내용, 타일링과 후처리 설정으로 만든다
+
+    모델 파일이 없다면 (메모리에서 만든 모델 등) None을 반환하며, 이 경우 캐시하지 않는다
+    """
+
+    if model_path is None or not os.path.exists(model_path):
+        return None
+
+    parameters = f"v{CACHE_VERSION}-{backend}-{CROP_IMAGE_SIZE}-{stride}-{BOX_SIZE}-{mask_analysis.MASK_THRESHOLD}"
+
+    return hashlib.sha1(f"{image_digest(image)}-{file_digest(model_path)}-{parameters}".encode()).hexdigest()
+
+def result_key(key, gradient):
+    """예측 키와 기울기로 분석 결과의 캐시 키를 만든다"""
+
+    return hashlib.sha1(f"{key}-{float(gradient)!r}".encode()).hexdigest()
+
+class AnalysisCache:
+    """
+    군집별 모멘트와 분석 결과를 디스크에 저장하는 LRU 캐시
+
+    파일 이름이 내용의 해시이므로 여러 프로세스가 같은 디렉토리를 함께 써도 된다. 읽을 때마다 파일의 수정 시각을
+    갱신하고, 전체 크기가 max_bytes를 넘으면 가장 오래 쓰이지 않은 파일부터 지운다.
+    캐시는 최적화일 뿐이므로 저장이나 정리 중의 OSError (읽기 전용 디렉토리, 디스크 부족 등)는 알리기만 하고 넘어간다.
+    """
+
+    def __init__(self, directory=ANALYSIS_CACHE_DIRECTORY, max_bytes=ANALYSIS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, f"{key}{extension}")
+
+    def touch(self, path):
+        """LRU 순서를 위해 수정 시각을 갱신한다"""
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def write(self, path, write):
+        """임시 파일에 쓴 뒤 이름을 바꾸므로, 다른 프로세스가 반쯤 쓰인 파일을 읽지 않는다"""
+
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+
+        try:
+            try:
+                with open(temporary_path, "wb") as f:
+                    write(f)
+                os.replace(temporary_path, path)
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+        except OSError as e:
+            print(f"analysis cache: could not write {path}: {e}")
+            return
+
+        self.evict()
+
+    def get_moments(self, key):
+        """캐시된 군집별 모멘트를 (레이블 이미지가 없는) Components로 반환하고, 없으면 None을 반환한다"""
+
+        path = self.path(key, ".moments.npz")
+
+        try:
+            with np.load(path) as entry:
+                components = mask_analysis.Components.from_moments(*(entry[field] for field in MOMENT_FIELDS))
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+
+        self.touch(path)
+        self.hits += 1
+
+        return components
+
+    def put_moments(self, key, components):
+        """군집별 모멘트만 저장한다 - 어떤 기울기의 S.SE든 다시 추론하지 않고 계산할 수 있다"""
+
+        arrays = {field: getattr(components, field) for field in MOMENT_FIELDS}
+        self.write(self.path(key, ".moments.npz"), lambda f: np.savez(f, **arrays))
+
+    def get_result(self, key, gradient):
+        """캐시된 분석 결과 (S.SE, 군집 수, 픽셀 수, 표준편차)를 반환하고, 없으면 None을 반환한다"""
+
+        path = self.path(result_key(key, gradient), ".json")
+
+        try:
+            with open(path) as f:
+                result = tuple(json.load(f))
+        except (FileNotFoundError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.touch(path)
+        self.hits += 1
+
+        return result
+
+    def put_result(self, key, gradient, result):
+        self.write(self.path(result_key(key, gradient), ".json"), lambda f: f.write(json.dumps(list(result)).encode()))
+
+    def evict(self):
+        """전체 크기가 max_bytes 이하가 될 때까지 가장 오래 쓰이지 않은 파일부터 지운다"""
+
+        entries = []
+
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        except OSError as e:
+            print(f"analysis cache: could not list {self.directory}: {e}")
+            return
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"analysis cache: could not remove {path}: {e}")
+                return
+
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                os.remove(entry.path)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(directory=ANALYSIS_CACHE_DIRECTORY):
+    """
+    디렉토리별로 하나의 캐시를 만들어 재사용한다
+
+    ANALYSIS_CACHE_MAX_BYTES가 0이거나 디렉토리를 만들 수 없다면 (읽기 전용 작업 디렉토리 등) None을 반환한다
+    """
+
+    if ANALYSIS_CACHE_MAX_BYTES <= 0:
+        return None
+
+    with _caches_lock:
+        if directory not in _caches:
+            try:
+                _caches[directory] = AnalysisCache(directory)
+            except OSError as e:
+                print(f"analysis cache disabled: {e}")
+                _caches[directory] = None
+
+        return _caches[directory]
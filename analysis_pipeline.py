@@ -0,0 +1,335 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import queue
+import threading
+import numpy as np
+
+from chunk_statistics import ChunkStatistics
+import image_source
+import inference_session
+import mask_analysis
+import tiling
+import tracing
+from settings import BOX_SIZE, CROP_IMAGE_SIZE, PIPELINE_QUEUE_SIZE, TILE_STRIDE
+
+# 단계가 끝났음을 다음 단계에 알리는 값
+_DONE = object()
+
+class _Failure:
+    """앞 단계에서 발생한 예외를 다음 단계로 넘기기 위한 상자"""
+
+    def __init__(self, error):
+        self.error = error
+
+class PipelineStopped(Exception):
+    """파이프라인이 중단되어 작업 스레드가 멈출 때 발생하는 예외"""
+
+def _put(output, item, stop):
+    """큐가 가득 차 있으면 기다리되, 파이프라인이 중단되면 멈춘다"""
+
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+    raise PipelineStopped()
+
+def _get(input, stop):
+    while not stop.is_set():
+        try:
+            return input.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+    raise PipelineStopped()
+
+def _run_stage(stage, output, stop, *args):
+    """작업 스레드에서 단계를 실행하고, 예외가 발생하면 다음 단계로 넘긴다"""
+
+    try:
+        stage(*args, output, stop)
+    except PipelineStopped:
+        pass
+    except BaseException as e:
+        try:
+            _put(output, _Failure(e), stop)
+        except PipelineStopped:
+            pass
+
+def tile_stage(source, positions, batch_size, output, stop):
+    """1단계 - 추론할 배치만큼의 타일만 읽어서 넘긴다"""
+
+    for start in range(0, len(positions), batch_size):
+        batch_positions = positions[start:start + batch_size]
+
+        with tracing.span("tiling") as span:
+            tiles = tiling.read_tiles(source, batch_positions, CROP_IMAGE_SIZE)
+            for tile in tiles:
+                tiling.random_shuffle_mask(tile)
+
+            span.set(tiles=len(tiles), nbytes=tiles.nbytes)
+
+        _put(output, (tiles, batch_positions), stop)
+
+    _put(output, _DONE, stop)
+
+def inference_stage(session, input, output, stop):
+    """2단계 - 타일 배치를 추론하고 타일별로 0~255 정규화하여 넘긴다"""
+
+    while True:
+        item = _get(input, stop)
+        if item is _DONE or isinstance(item, _Failure):
+            _put(output, item, stop)
+            return
+
+        tiles, positions = item
+
+        with tracing.span("inference", tiles=len(tiles)):
+            predicts = mask_analysis.normalize_predictions(session.predict(tiles))
+
+        _put(output, (predicts, positions), stop)
+
+def band_stage(height, width, channels, positions, input, output, stop):
+    """
+    3단계 - 예측을 위에서부터 이어붙이고, 완성된 행을 띠 단위로 이진화, 레이블링하여 닫힌 군집의 모멘트를 넘긴다
+
+    타일 한 줄이 모두 더해지면 다음 타일 줄이 시작되는 행까지는 더 이상 바뀌지 않으므로 바로 꺼내서 처리한다
+    """
+
+    padded_height = max(height, CROP_IMAGE_SIZE)
+    stitcher = tiling.RowStitcher(height, width, channels, CROP_IMAGE_SIZE)
+    binarizer = BandBinarizer()
+    labeler = BandLabeler()
+
+    # 타일은 줄 순서대로 오므로, 각 타일 줄의 시작 행과 그 줄의 마지막 타일 다음 번호를 구해둔다
+    row_origins, row_counts = np.unique([y for _, y in positions], return_counts=True)
+    row_ends = np.cumsum(row_counts)
+
+    tiles_done, row = 0, 0
+
+    while True:
+        item = _get(input, stop)
+        if isinstance(item, _Failure):
+            _put(output, item, stop)
+            return
+        if item is _DONE:
+            break
+
+        predicts, batch_positions = item
+        closed = []
+
+        with tracing.span("stitching", tiles=len(predicts)):
+            for predict, (x, y) in zip(predicts, batch_positions):
+                stitcher.add(predict, x, y)
+                tiles_done += 1
+
+                # 한 줄이 끝나면 다음 줄이 시작되는 행까지 꺼내서 이진화, 레이블링
+                if tiles_done == row_ends[row]:
+                    last = row + 1 == len(row_origins)
+                    rows = stitcher.take(padded_height if last else row_origins[row + 1])
+                    band, start_row = binarizer.feed(rows, final=last)
+                    row += 1
+
+                    if band is not None:
+                        with tracing.span("labelling", rows=len(band)):
+                            closed.append(labeler.add(band, start_row))
+
+        if row == len(row_origins):
+            closed.append(labeler.finish())
+
+        _put(output, (np.concatenate(closed, axis=1) if closed else np.zeros((6, 0)), tiles_done), stop)
+
+    _put(output, _DONE, stop)
+
+class BandBinarizer:
+    """이어붙인 행을 BOX_SIZE의 배수 높이의 띠로 모아 이진화한다 - 남는 행은 다음 띠에 붙인다"""
+
+    def __init__(self):
+        self.pending = None
+        self.start_row = 0
+
+    def feed(self, rows, final=False):
+        """(이진화한 띠, 띠의 시작 행)을 반환 - 이진화할 행이 모이지 않았다면 띠는 None"""
+
+        if self.pending is not None:
+            rows = np.concatenate([self.pending, rows])
+
+        usable = len(rows) if final else len(rows) // BOX_SIZE * BOX_SIZE
+        start_row = self.start_row
+
+        self.pending = rows[usable:]
+        self.start_row += usable
+
+        if usable == 0:
+            return None, start_row
+
+        return mask_analysis.binarize_rows(rows[:usable], start_row), start_row
+
+class BandLabeler:
+    """
+    마스크를 띠 단위로 레이블링하고, 띠 경계를 넘어 이어진 군집을 union-find로 합치는 클래스
+
+    군집은 픽셀 수와 좌표의 합, 제곱합, 곱의 합 (6, ) 모멘트로 나타내므로 합칠 때는 더하기만 하면 된다.
+    아래 띠로 이어질 수 있는 (띠의 마지막 행에 닿은) 군집만 남겨두고, 나머지는 닫힌 군집으로 바로 반환한다.
+    """
+
+    def __init__(self):
+        self.next_id = 0
+        self.open = {}  # 열린 군집 번호 -> 모멘트
+        self.boundary = None  # 이전 띠 마지막 행의 열린 군집 번호 (배경은 -1)
+
+    def add(self, band, start_row):
+        """띠 하나를 추가하고 닫힌 군집들의 (6, K) 모멘트를 반환"""
+
+        from scipy.ndimage import label
+
+        labels, n = label(band != 0)
+
+        # 군집별 모멘트
+        ys, xs = np.nonzero(labels)
+        local_ids = labels[ys, xs] - 1
+        xs, ys = xs.astype("float64"), (ys + start_row).astype("float64")
+        moments = np.stack([np.bincount(local_ids, weights=weights, minlength=n) for weights in (np.ones_like(xs), xs, ys, xs * xs, ys * ys, xs * ys)])
+
+        ids = self.next_id + np.arange(n)
+        self.next_id += n
+
+        parent = {}
+
+        def find(a):
+            root = a
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while a != root:
+                parent[a], a = root, parent[a]
+            return root
+
+        # 이전 띠의 마지막 행과 이 띠의 첫 행에서 위아래로 맞닿은 군집을 합친다
+        linked = np.zeros(n, dtype=bool)
+
+        if self.boundary is not None and n > 0:
+            first_row = labels[0]
+            touching = (self.boundary >= 0) & (first_row > 0)
+            pairs = np.unique(np.stack([self.boundary[touching], ids[first_row[touching] - 1]], axis=1), axis=0)
+
+            for upper, lower in pairs.tolist():
+                parent.setdefault(upper, upper)
+                parent.setdefault(lower, lower)
+                parent[find(lower)] = find(upper)
+
+            linked[pairs[:, 1] - ids[0]] = True
+
+        # 합쳐진 군집의 모멘트를 대표 번호로 모은다
+        merged = {}
+        for root, root_moments in self.open.items():
+            representative = find(root)
+            merged[representative] = merged.get(representative, 0) + root_moments
+
+        representatives = ids.copy()
+        for local in np.flatnonzero(linked):
+            representatives[local] = find(int(ids[local]))
+            merged[representatives[local]] = merged.get(representatives[local], 0) + moments[:, local]
+
+        # 마지막 행에 닿은 군집은 다음 띠로 이어질 수 있으므로 열어둔다
+        last_row = labels[-1]
+        self.boundary = np.concatenate([[-1], representatives])[last_row]
+        open_roots = set(np.unique(self.boundary[self.boundary >= 0]).tolist())
+
+        touches_last_row = np.zeros(n, dtype=bool)
+        touches_last_row[last_row[last_row > 0] - 1] = True
+
+        self.open = {root: root_moments for root, root_moments in merged.items() if root in open_roots}
+        self.open.update((int(ids[local]), moments[:, local]) for local in np.flatnonzero(~linked & touches_last_row))
+
+        closed = [root_moments for root, root_moments in merged.items() if root not in open_roots]
+
+        return np.concatenate([moments[:, ~linked & ~touches_last_row], np.array(closed).reshape(-1, 6).T], axis=1)
+
+    def finish(self):
+        """남은 열린 군집을 모두 닫아서 (6, K) 모멘트로 반환"""
+
+        closed = np.array(list(self.open.values())).reshape(-1, 6).T
+
+        self.open = {}
+        self.boundary = None
+
+        return closed
+
+def analyze_pipelined(target_gradient, image, session=None, stride=TILE_STRIDE, progress=None, on_band=None):
+    """
+    타일 읽기 → 배치 추론 → 이어붙이기, 이진화, 레이블링 → 회귀 단계를 작업 스레드로 나누어 동시에 실행하는 분석
+
+    단계 사이는 크기가 PIPELINE_QUEUE_SIZE인 큐로 이어져 있으므로, 이미지 크기와 상관없이 한번에 메모리에 있는 타일과 행의
+    수가 제한된다. 닫힌 군집은 바로 회귀하여 ChunkStatistics에 누적하며, on_band가 주어지면 배치마다
+    on_band(그 배치의 통계, 지금까지의 통계)를 호출한다.
+
+    analyze_original_image와 같은 (S.SE, 군집 수, 픽셀 수, 표준편차)와, 다른 기울기로 다시 계산할 수 있도록 군집별 모멘트만
+    담은 Components (Components.from_moments - 군집 수에 비례하는 크기)를 (결과, Components)로 반환한다.
+    """
+
+    if session is None:
+        session = inference_session.get_session()
+
+    source = image_source.as_image_source(image)
+    positions = tiling.tile_positions(max(source.height, CROP_IMAGE_SIZE), max(source.width, CROP_IMAGE_SIZE), CROP_IMAGE_SIZE, stride)
+
+    stop = threading.Event()
+    tiles, predicts, bands = (queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in range(3))
+
+    threads = [
+        threading.Thread(target=_run_stage, args=(tile_stage, tiles, stop, source, positions, session.batch_size), daemon=True),
+        threading.Thread(target=_run_stage, args=(inference_stage, predicts, stop, session, tiles), daemon=True),
+        threading.Thread(target=_run_stage, args=(band_stage, bands, stop, source.height, source.width, session.output_channels, positions, predicts), daemon=True),
+    ]
+
+    statistics = ChunkStatistics()
+    chunks = []
+
+    try:
+        for thread in threads:
+            thread.start()
+
+        # 4단계 - 닫힌 군집을 회귀하여 통계에 누적한다
+        while True:
+            item = _get(bands, stop)
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+
+            closed, tiles_done = item
+            area, sum_x, sum_y, sum_xx, sum_yy, sum_xy = closed
+
+            with tracing.span("regression", chunks=len(area)):
+                m_xx, m_yy, m_xy = mask_analysis.moments_to_central(area, sum_x, sum_y, sum_xx, sum_yy, sum_xy)
+                band_statistics = ChunkStatistics().add(area, mask_analysis.component_regression_losses(target_gradient, m_xx, m_yy, m_xy).sum())
+                statistics.merge(band_statistics)
+                chunks.append(np.stack([area, sum_x, sum_y, m_xx, m_yy, m_xy]))
+
+            if progress is not None:
+                progress("tiles", tiles_done, len(positions))
+            if on_band is not None:
+                on_band(band_statistics, statistics)
+    finally:
+        stop.set()
+
+    statistics.n_images = 1
+    chunks = np.concatenate(chunks, axis=1) if chunks else np.zeros((6, 0))
+
+    return statistics.result(), mask_analysis.Components.from_moments(*chunks)
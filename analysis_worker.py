@@ -0,0 +1,107 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+import ml_model
+import tracing
+
+class AnalysisCancelled(Exception):
+    """분석이 취소되었을 때 발생하는 예외"""
+
+class AnalysisJob:
+    """
+    화면이 멈추지 않도록 백그라운드 스레드에서 분석을 수행하는 작업
+
+    추론과 군집 추출은 한번만 하고, target_gradients의 모든 기울기에 대한 S.SE를 한번에 계산한다.
+    진행 상황과 결과는 작업 객체에 기록되며, 화면 쪽(메인 스레드)에서 status_text로 읽어간다.
+    result는 (기울기별 S.SE 리스트, 군집 수, 픽셀 수, 표준편차, 가장 잘 맞는 각도)이다.
+    """
+
+    def __init__(self, target_gradients, image, session=None):
+        self.target_gradients = list(target_gradients)
+        self.image = image
+        self.session = session
+
+        self.stage = "waiting"
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.elapsed = 0.0
+
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """백그라운드 스레드에서 분석을 시작한다"""
+
+        self.thread.start()
+
+    def cancel(self):
+        """분석을 취소한다 - 다음 진행 보고 시점에 중단된다"""
+
+        self.cancel_event.set()
+
+    @property
+    def finished(self):
+        return not self.thread.is_alive() and (self.result is not None or self.error is not None or self.cancelled)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def report_progress(self, stage, done, total):
+        """분석 중 진행 상황을 기록하는 콜백 - 취소되었다면 AnalysisCancelled를 발생시킨다"""
+
+        if self.cancel_event.is_set():
+            raise AnalysisCancelled()
+
+        self.stage, self.done, self.total = stage, done, total
+
+    def run(self):
+        start = time.perf_counter()
+
+        try:
+            with tracing.span("analyze", lines=len(self.target_gradients)):
+                # session이 없다면 캐시에 군집이 없을 때만 모델을 불러온다 (모델 로딩도 화면을 멈추지 않는다)
+                components = ml_model.extract_components(self.image, self.session, progress=self.report_progress)
+
+                _, n_chunks, n_pixels, std_dev = ml_model.evaluate_components(self.target_gradients[0], components)
+                losses = ml_model.sweep_gradients(self.target_gradients, components)
+
+            self.result = losses.tolist(), n_chunks, n_pixels, std_dev, ml_model.best_fitting_angle(components)
+        except AnalysisCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+
+        self.elapsed = time.perf_counter() - start
+
+    def status_text(self):
+        """상태 패널에 보여줄 한 줄 요약"""
+
+        if self.cancelled:
+            return "cancelled"
+        if self.error is not None:
+            return f"failed ({self.error})"
+        if self.result is not None:
+            return f"done in {self.elapsed:.1f}s"
+        if self.total > 0:
+            return f"{self.stage} {self.done}/{self.total}"
+
+        return self.stage
@@ -15,10 +15,12 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from enum import Enum
+import time
 from crop_manager import CropManager
 from line_tracer import LineTracerManager
-from renderer import ImageRenderer, RenderTasks
+from renderer import ImageRenderer, RenderLayer, RenderTasks
 from input_manager import HairSEMEvents, InputManager
+from frame_pacer import FramePacer
 
 class ApplicationMode(Enum):
     LINE_TRACING = 0
@@ -32,12 +34,20 @@ class ApplicationManager:
         self.input_manager = input_manager
         self.mode = ApplicationMode.LINE_TRACING
         self.status_panel = {}
+        self.frame_pacer = FramePacer()
 
-        self.line_tracer_manager = LineTracerManager(renderer, input_manager)
+        self.line_tracer_manager = LineTracerManager(renderer, input_manager, self.status_panel)
         self.crop_manager = CropManager(renderer, input_manager)
 
         self.line_tracer_manager.initialize()
 
+    def close(self):
+        """프로그램을 끝낼 때 호출한다 - 진행 중인 분석과 피라미드 만들기를 멈추고, 남은 crop을 모두 저장한다"""
+
+        self.line_tracer_manager.cancel_analysis()
+        self.renderer.close()
+        self.crop_manager.close()
+
     def handle_inputs(self):
         """
         호출된 이벤트를 처리하는 함수
@@ -76,8 +86,10 @@ class ApplicationManager:
         앱 업데이트(tick)
         """        
 
-        # 입력 관리자를 업데이트
-        self.input_manager.update()
+        # 입력이 들어오거나 프레임 페이서가 정한 시간이 지날 때까지 기다리며 입력 관리자를 업데이트
+        wait_start = time.perf_counter()
+        self.input_manager.update(self.frame_pacer.wait_ms)
+        idle_seconds = time.perf_counter() - wait_start
 
         # 호출된 이벤트 처리하기
         self.handle_inputs()
@@ -91,10 +103,17 @@ class ApplicationManager:
             self.crop_manager.update()
 
         # 왼쪽 상단에 현재 모드를 보여주기
-        self.renderer.push_task(RenderTasks.WRITE_TEXT, [f"mode : {mode_text}", (10, 30)])
+        self.renderer.push_task(RenderTasks.WRITE_TEXT, [f"mode : {mode_text}", (10, 30)], RenderLayer.STATIC)
 
         for i, (k, v) in enumerate(self.status_panel.items()):
             status_panel_text = f"{k}: {v}"
-            self.renderer.push_task(RenderTasks.WRITE_TEXT, [status_panel_text, (10, 30 * (i + 2))])
+            self.renderer.push_task(RenderTasks.WRITE_TEXT, [status_panel_text, (10, 30 * (i + 2))], RenderLayer.STATIC)
+
+        redrawn = self.renderer.update()
+
+        # 입력, 화면 변경, 진행 중인 분석이 없으면 다음 프레임까지 더 오래 쉰다
+        active = self.input_manager.active or redrawn or self.line_tracer_manager.analysis_job is not None
 
-        self.renderer.update()
+        # 루프 통계는 측정 구간마다 한번만 갱신하여 정적 레이어를 매 프레임 다시 그리지 않는다
+        if self.frame_pacer.tick(active, idle_seconds):
+            self.status_panel["loop"] = self.frame_pacer.summary
@@ -0,0 +1,170 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import glob
+import json
+import os
+import time
+import cv2
+
+from chunk_statistics import ChunkStatistics
+import geometrics
+import image_source
+import ml_model
+import tracing
+from settings import ANALYSIS_CACHE_DIRECTORY, CROP_IMAGE_SIZE, MODEL_PATH, TFLITE_MODEL_PATH, TILE_STRIDE, X_SIZE, Y_SIZE
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".npy") + image_source.RAW_EXTENSIONS
+RESULT_FIELDS = ["path", "s_se", "n_chunks", "n_pixels", "std_dev", "seconds", "error"]
+
+# 작업 프로세스가 사용할 (모델 경로, 백엔드) - 세션은 inference_session.get_session이 프로세스마다 하나씩 만든다
+_worker_model = None, None
+
+def find_images(patterns):
+    """디렉토리 또는 glob 패턴 목록에서 분석할 이미지 경로를 찾는다"""
+
+    paths = []
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(os.path.join(pattern, file) for file in sorted(os.listdir(pattern)) if file.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.extend(sorted(glob.glob(pattern)))
+
+    return paths
+
+def initialize_worker(model_path, backend=None):
+    """작업 프로세스 초기화 - 모델은 캐시에 없는 이미지를 처음 분석할 때 한번만 불러온다"""
+
+    global _worker_model
+    _worker_model = model_path, backend
+
+    tracing.initialize_worker()
+
+def analyze_path(path, gradient, stride=TILE_STRIDE, resize=False, use_cache=True, raw_shape=None, raw_dtype="uint8"):
+    """
+    이미지 하나를 분석하여 결과를 딕셔너리로 반환 - use_cache가 True라면 분석 캐시를 먼저 확인한다
+
+    raw_shape, raw_dtype은 .raw/.bin 이미지의 (높이, 너비[, 채널])와 자료형이다 (이미지 옆에 JSON 파일이 있다면 그것을 따른다)
+    """
+
+    if os.path.exists(image_source.raw_sidecar_path(path)):
+        raw_shape = None
+
+    start = time.perf_counter()
+    result = {"path": path}
+
+    try:
+        # 뷰어와 같이 원본 해상도로 분석하며, 큰 TIFF, .npy, raw 이미지는 메모리 매핑하여 추론할 타일만 읽는다
+        image = image_source.open_image(path, raw_shape, raw_dtype)
+
+        # 이전 버전의 뷰어와 같은 결과를 얻으려면 같은 크기로 조정한다
+        if resize:
+            image = cv2.resize(image.read_region(0, 0, image.width, image.height), (X_SIZE, Y_SIZE))
+
+        s_se, n_chunks, n_pixels, std_dev = ml_model.analyze_original_image(gradient, image, None, stride, cache=None if use_cache else False, model_path=_worker_model[0], backend=_worker_model[1])
+        result.update(s_se=s_se, n_chunks=n_chunks, n_pixels=n_pixels, std_dev=std_dev)
+    except Exception as e:
+        result["error"] = str(e)
+
+    result["seconds"] = time.perf_counter() - start
+
+    return result
+
+def analyze_paths(paths, gradient, model_path=None, workers=1, stride=TILE_STRIDE, resize=False, backend=None, use_cache=True, raw_shape=None, raw_dtype="uint8"):
+    """
+    여러 이미지를 분석한다
+
+    workers가 1보다 크면 프로세스 풀에 나누어 분석하며, 각 작업 프로세스는 모델을 한번만 불러와 재사용한다
+    """
+
+    arguments = [(path, gradient, stride, resize, use_cache, raw_shape, raw_dtype) for path in paths]
+
+    if workers <= 1:
+        initialize_worker(model_path, backend)
+        return [analyze_path(*argument) for argument in arguments]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initialize_worker, initargs=(model_path, backend)) as executor:
+        futures = [executor.submit(analyze_path, *argument) for argument in arguments]
+        return [future.result() for future in futures]
+
+def summarize_results(results):
+    """성공한 이미지들의 결과를 합쳐 전체 군집 통계를 만든다 (군집 크기를 모두 모으지 않고 이미지별 통계를 병합한다)"""
+
+    statistics = ChunkStatistics()
+
+    for result in results:
+        if "error" not in result:
+            statistics.merge(ChunkStatistics.from_result((result["s_se"], result["n_chunks"], result["n_pixels"], result["std_dev"])))
+
+    return statistics
+
+def write_results(results, output_path):
+    """확장자에 따라 결과를 CSV 또는 JSON으로 저장한다"""
+
+    if output_path.lower().endswith(".json"):
+        with open(output_path, "w") as f:
+            json.dump(results, f, indent=2)
+        return
+
+    with open(output_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SEM 이미지 폴더를 화면 없이 일괄 분석한다")
+    parser.add_argument("inputs", nargs="+", help="이미지 디렉토리 또는 glob 패턴")
+
+    direction = parser.add_mutually_exclusive_group(required=True)
+    direction.add_argument("--angle", type=float, help="큐티클 선의 각도 (화면 기준 수평선에서 반시계 방향, 도)")
+    direction.add_argument("--gradient", type=float, help="회귀에 사용할 기울기 (cv2 좌표계)")
+
+    parser.add_argument("--output", default="results.csv", help="결과 파일 (.csv 또는 .json)")
+    parser.add_argument("--model", default=None, help=f"사전 학습된 모델 경로 (기본값: {MODEL_PATH} 또는 {TFLITE_MODEL_PATH})")
+    parser.add_argument("--backend", choices=["keras", "tflite"], default=None, help="추론 백엔드 (기본값: settings.INFERENCE_BACKEND)")
+    parser.add_argument("--workers", type=int, default=1, help="작업 프로세스 수")
+    parser.add_argument("--stride", type=int, default=TILE_STRIDE, help=f"타일 간격 (1~{CROP_IMAGE_SIZE})")
+    parser.add_argument("--no-cache", action="store_true", help=f"{ANALYSIS_CACHE_DIRECTORY}의 분석 캐시를 쓰지 않는다")
+    parser.add_argument("--raw-shape", type=image_source.parse_shape, default=None, help=".raw/.bin 이미지의 높이,너비[,채널] (이미지 옆에 <파일 이름>.json이 있다면 그것을 따른다)")
+    parser.add_argument("--raw-dtype", default="uint8", help=".raw/.bin 이미지의 자료형 (uint8, uint16 등)")
+    parser.add_argument("--resize", action="store_true", help=f"원본 해상도 대신 {X_SIZE}x{Y_SIZE}로 크기를 조정하여 분석한다 (이전 버전의 결과와 비교할 때)")
+    args = parser.parse_args(argv)
+
+    if not 0 < args.stride <= CROP_IMAGE_SIZE:
+        parser.error(f"--stride must be between 1 and {CROP_IMAGE_SIZE}")
+
+    paths = find_images(args.inputs)
+    if len(paths) == 0:
+        parser.error("no images found")
+
+    gradient = args.gradient if args.gradient is not None else geometrics.perpendicular_gradient_from_angle(args.angle)
+
+    start = time.perf_counter()
+    results = analyze_paths(paths, gradient, args.model, args.workers, args.stride, args.resize, args.backend, not args.no_cache, args.raw_shape, args.raw_dtype)
+    elapsed = time.perf_counter() - start
+
+    write_results(results, args.output)
+
+    failed = sum(1 for result in results if "error" in result)
+    print(f"analyzed {len(results) - failed} images ({failed} failed) in {elapsed:.1f}s -> {args.output}")
+    print(f"total: {summarize_results(results).summary()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+import dataset_manager
+import mask_analysis
+import ml_model
+from settings import CROP_IMAGE_SIZE, TILE_STRIDE
+
+DEFAULT_SIZES = ["256x256", "1000x600", "2000x1200"]
+BENCHMARK_GRADIENT = 1.7320508075688776  # 30도 큐티클 선에 수직한 기울기
+
+def make_synthetic_sem(width, height, seed=0):
+    """
+    SEM 이미지와 비슷한 합성 데이터를 만든다
+
+    비스듬한 큐티클 경계가 있는 잡음 섞인 회색 이미지, 경계에 파란 선을 그린 마스크 이미지,
+    모델 예측처럼 경계 근처에서 값이 커지는 (H, W, 3) float32 예측을 (image, mask_image, prediction)으로 반환한다
+    """
+
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:height, 0:width]
+
+    # 30도로 기울어진 큐티클 경계 사이의 거리
+    phase = (xs * np.sin(np.radians(30)) + ys * np.cos(np.radians(30))) % 40
+    distance = np.minimum(phase, 40 - phase)
+
+    gray = 120 + 60 * np.exp(-distance / 3) + rng.normal(0, 12, (height, width))
+    image = np.repeat(np.clip(gray, 0, 255).astype("uint8")[:, :, np.newaxis], 3, axis=2)
+
+    # 경계에 파란 선을 그린 마스크 이미지
+    mask_image = image.copy()
+    mask_image[distance < 1.5] = (255, 40, 40)
+
+    prediction = np.stack([np.exp(-distance / 2) + rng.normal(0, 0.05, (height, width))] * 3, axis=2).astype("float32")
+
+    return image, mask_image, prediction
+
+def parse_size(size):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+def measure(function, repeat):
+    """function을 한번 미리 실행한 뒤 repeat번 실행하여 시간들과 (tracemalloc으로 잰) 최대 메모리를 반환"""
+
+    function()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    # tracemalloc은 실행을 느리게 하므로 메모리는 따로 한번 더 실행하여 잰다
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return times, peak
+
+def build_stages(width, height, directory, session=None):
+    """(단계 이름, 실행할 함수) 목록을 만든다 - 입력 데이터는 시간을 재기 전에 미리 만들어 둔다"""
+
+    image, mask_image, prediction = make_synthetic_sem(width, height)
+
+    mask_image_path = os.path.join(directory, f"mask-{width}x{height}.png")
+    cv2.imwrite(mask_image_path, mask_image)
+
+    coerced = mask_analysis.coerce_image(prediction)
+    flattened = mask_analysis.flatten_predicted_mask(coerced.copy())
+    chunks = mask_analysis.chunkify(flattened)
+
+    stages = [
+        ("extract_masks", lambda: dataset_manager.extract_masks(mask_image_path)),
+        ("coerce_image", lambda: mask_analysis.coerce_image(prediction)),
+        ("flatten_predicted_mask", lambda: mask_analysis.flatten_predicted_mask(coerced.copy())),
+        ("chunkify", lambda: mask_analysis.chunkify(flattened)),
+        ("mask_linear_regression", lambda: [mask_analysis.mask_linear_regression(BENCHMARK_GRADIENT, chunk) for chunk in chunks]),
+    ]
+
+    if session is not None:
+        tiles = np.stack([image[y:y + CROP_IMAGE_SIZE, x:x + CROP_IMAGE_SIZE] for y in range(0, height - CROP_IMAGE_SIZE + 1, CROP_IMAGE_SIZE) for x in range(0, width - CROP_IMAGE_SIZE + 1, CROP_IMAGE_SIZE)])
+
+        stages += [
+            ("get_predicted_mask", lambda: ml_model.get_predicted_mask(tiles, session)),
+            ("analyze_original_image", lambda: ml_model.analyze_original_image(BENCHMARK_GRADIENT, image, session, TILE_STRIDE, cache=False)),
+        ]
+
+    return stages
+
+def random_weight_session():
+    """무작위 가중치의 작은 unet_model로 추론 세션을 만든다 - 텐서플로가 없다면 None"""
+
+    try:
+        from inference_session import InferenceSession
+        return InferenceSession(model=ml_model.unet_model(weights=None))
+    except ImportError as e:
+        print(f"skipping the model stages: {e}")
+        return None
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=5, stage_names=None, use_model=True):
+    """모든 크기에 대해 단계별 시간, 처리량(메가픽셀/초), 최대 메모리를 재서 딕셔너리로 반환"""
+
+    session = random_weight_session() if use_model else None
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            width, height = parse_size(size)
+
+            for name, function in build_stages(width, height, directory, session):
+                if stage_names and name not in stage_names:
+                    continue
+
+                times, peak = measure(function, repeat)
+                best = min(times)
+
+                results.setdefault(name, {})[size] = {
+                    "best_seconds": best,
+                    "median_seconds": statistics.median(times),
+                    "megapixels_per_second": width * height / 1e6 / best,
+                    "peak_bytes": peak,
+                }
+
+                print(f"{name:>24} {size:>10}  {best * 1000:9.2f}ms  {width * height / 1e6 / best:9.2f}MP/s  {peak / 1e6:8.2f}MB")
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "repeat": repeat,
+        "results": results,
+    }
+
+def compare(baseline, current, threshold=0.1):
+    """
+    기준 결과와 현재 결과의 가장 빠른 시간을 비교해 출력한다
+
+    threshold보다 많이 느려진 (단계, 크기) 목록을 반환한다
+    """
+
+    regressions = []
+
+    for name, sizes in current["results"].items():
+        for size, result in sizes.items():
+            reference = baseline["results"].get(name, {}).get(size)
+            if reference is None:
+                continue
+
+            ratio = result["best_seconds"] / reference["best_seconds"]
+            memory_ratio = result["peak_bytes"] / max(reference["peak_bytes"], 1)
+            flag = "  <- slower" if ratio > 1 + threshold else ""
+
+            print(f"{name:>24} {size:>10}  x{ratio:5.2f} time  x{memory_ratio:5.2f} memory{flag}")
+
+            if ratio > 1 + threshold:
+                regressions.append((name, size))
+
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="합성 SEM 이미지로 분석 단계별 성능을 측정한다")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="이미지 크기 (너비x높이)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--stages", nargs="+", default=None, help="측정할 단계 (기본값: 전부)")
+    parser.add_argument("--no-model", action="store_true", help="모델이 필요한 단계는 건너뛴다")
+    parser.add_argument("--output", default="benchmark.json", help="결과를 저장할 JSON 파일")
+    parser.add_argument("--compare", default=None, help="비교할 기준 JSON 파일")
+    parser.add_argument("--threshold", type=float, default=0.1, help="느려졌다고 표시할 비율")
+    args = parser.parse_args(argv)
+
+    current = run_benchmarks(args.sizes, args.repeat, args.stages, not args.no_model)
+
+    with open(args.output, "w") as f:
+        json.dump(current, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = compare(baseline, current, args.threshold)
+        print(f"{len(regressions)} regressions")
+
+        return 1 if regressions else 0
+
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,111 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import numpy as np
+
+class ChunkStatistics:
+    """
+    군집 통계(이미지 수, 군집 수, 픽셀 수, S.SE, 군집 크기의 평균과 분산)를 누적하는 클래스
+
+    군집 크기를 모두 저장하지 않고 Welford 방식으로 평균과 편차 제곱합만 누적하므로, 타일이나 이미지 단위로
+    조금씩 추가할 수 있다. merge로 다른 타일, 이미지, 작업 프로세스의 통계를 합칠 수 있다 (Chan의 병합 공식).
+    """
+
+    def __init__(self):
+        self.n_images = 0
+        self.n_chunks = 0
+        self.n_pixels = 0
+        self.s_se = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0  # 평균에 대한 편차 제곱합
+
+    @classmethod
+    def from_components(cls, components, gradient):
+        """이미지 하나의 Components와 기울기로 통계를 만든다"""
+
+        statistics = cls()
+        statistics.add(components.area, components.regression_losses(gradient).sum() if len(components) > 0 else 0.0)
+        statistics.n_images = 1
+
+        return statistics
+
+    @classmethod
+    def from_result(cls, result):
+        """analyze_original_image의 결과 (S.SE, 군집 수, 픽셀 수, 표준편차)로 이미지 하나의 통계를 만든다"""
+
+        s_se, n_chunks, n_pixels, std_dev = result
+
+        statistics = cls()
+        statistics.n_images = 1
+        statistics.n_chunks = int(n_chunks)
+        statistics.n_pixels = int(n_pixels)
+        statistics.s_se = float(s_se)
+        statistics.mean = n_pixels / n_chunks if n_chunks > 0 else 0.0
+        statistics.m2 = std_dev * std_dev * n_chunks
+
+        return statistics
+
+    def add(self, areas, s_se=0.0):
+        """군집 크기 배열과 그 군집들의 S.SE를 추가한다 (타일 하나의 군집 등)"""
+
+        areas = np.asarray(areas, dtype="float64")
+
+        batch = ChunkStatistics()
+        batch.n_chunks = len(areas)
+        batch.n_pixels = int(areas.sum())
+        batch.s_se = float(s_se)
+
+        if len(areas) > 0:
+            batch.mean = batch.n_pixels / batch.n_chunks
+            batch.m2 = float(((areas - batch.mean) ** 2).sum())
+
+        return self.merge(batch)
+
+    def merge(self, other):
+        """다른 통계를 합친다 - 자기 자신을 반환한다"""
+
+        n = self.n_chunks + other.n_chunks
+
+        if n > 0:
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta * delta * self.n_chunks * other.n_chunks / n
+            self.mean += delta * other.n_chunks / n
+
+        self.n_images += other.n_images
+        self.n_chunks = n
+        self.n_pixels += other.n_pixels
+        self.s_se += other.s_se
+
+        return self
+
+    @property
+    def variance(self):
+        """군집 크기의 모분산 (군집이 없다면 0)"""
+
+        return self.m2 / self.n_chunks if self.n_chunks > 0 else 0.0
+
+    @property
+    def std_dev(self):
+        return math.sqrt(self.variance)
+
+    def result(self):
+        """analyze_original_image와 같은 형태의 (S.SE, 군집 수, 픽셀 수, 표준편차)"""
+
+        return self.s_se, self.n_chunks, self.n_pixels, self.std_dev
+
+    def summary(self):
+        return f"{self.n_images} images, {self.n_chunks} chunks, {self.n_pixels} pixels, S.SE {self.s_se:.2f}, mean {self.mean:.2f}, std_dev {self.std_dev:.2f}"
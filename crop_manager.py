@@ -14,11 +14,14 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import random
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import os
+import threading
 import numpy as np
-from renderer import ImageRenderer, RenderTasks
+from renderer import ImageRenderer, RenderLayer, RenderTasks
 from input_manager import HairSEMEvents, InputManager, SubscriptionType
-from settings import CROP_IMAGE_SIZE, X_SIZE, Y_SIZE
+from settings import AUTO_CROP_SAMPLES, CROP_IMAGE_SIZE, CROP_MANIFEST_PATH, CROP_SEED, CROP_WRITER_WORKERS
 import uuid
 import cv2
 
@@ -30,6 +33,7 @@ class CropManager:
         self.input_manager = input_manager
         self.start_point = None
         self.lock = False
+        self.writer = CropWriter()
 
     def initialize(self):
         self.input_manager.subscribe(SubscriptionType.LEFT_CLICK, self.on_click)
@@ -62,14 +66,20 @@ class CropManager:
         self.render_box()
     
     def on_click(self, x, y):
-        """좌클릭 콜백"""
+        """좌클릭 콜백 - 점은 이미지 좌표로 저장한다"""
 
         if self.lock:
             return
         
         # when choosing the first point
         if self.start_point is None:  
-            self.start_point = (x, y)
+            image_x, image_y = self.renderer.to_image_coordinates((x, y))
+
+            # 축소, 이동한 화면에서 이미지 밖을 클릭했다면 무시한다
+            if not (0 <= image_x < self.renderer.image_width and 0 <= image_y < self.renderer.image_height):
+                return
+
+            self.start_point = image_x, image_y
             self.lock = True
 
     def render_box(self):
@@ -77,45 +87,138 @@ class CropManager:
 
         start_x, start_y = self.start_point
 
-        p2 = start_x, start_y + CROP_IMAGE_SIZE
-        p3 = start_x + CROP_IMAGE_SIZE, start_y + CROP_IMAGE_SIZE
-        p4 = start_x + CROP_IMAGE_SIZE, start_y
+        # crop은 raw_image에서 CROP_IMAGE_SIZE 크기로 하므로 이미지 좌표에서의 크기로 바꾼다
+        size_x = CROP_IMAGE_SIZE * self.renderer.image_width / self.renderer.raw_image.shape[1]
+        size_y = CROP_IMAGE_SIZE * self.renderer.image_height / self.renderer.raw_image.shape[0]
+
+        p2 = start_x, start_y + size_y
+        p3 = start_x + size_x, start_y + size_y
+        p4 = start_x + size_x, start_y
+
+        self.renderer.push_task(RenderTasks.DRAW_LINE, [self.start_point, p2], RenderLayer.STATIC)
+        self.renderer.push_task(RenderTasks.DRAW_LINE, [p2, p3], RenderLayer.STATIC)
+        self.renderer.push_task(RenderTasks.DRAW_LINE, [p3, p4], RenderLayer.STATIC)
+        self.renderer.push_task(RenderTasks.DRAW_LINE, [p4, self.start_point], RenderLayer.STATIC)
+
+    def save(self, images, n_samples=AUTO_CROP_SAMPLES, seed=CROP_SEED):
+        """
+        저장한다
 
-        self.renderer.push_task(RenderTasks.DRAW_LINE, [self.start_point, p2])
-        self.renderer.push_task(RenderTasks.DRAW_LINE, [p2, p3])
-        self.renderer.push_task(RenderTasks.DRAW_LINE, [p3, p4])
-        self.renderer.push_task(RenderTasks.DRAW_LINE, [p4, self.start_point])
+        crop은 원본 배열의 뷰로 잘라내고, 인코딩과 저장은 백그라운드 스레드 풀에서 처리하므로 화면이 멈추지 않는다
+        """
 
-    def save(self, images):
-        """저장한다"""
+        height = min(image.shape[0] for image in images)
+        width = min(image.shape[1] for image in images)
 
-        # 딱히 네모 상자를 정하지 않았다면, 랜덤하게 500회 수행
+        # 딱히 네모 상자를 정하지 않았다면, 랜덤한 위치 n_samples개를 한번에 선정
         if self.start_point is None:
-            for i in range(500):
+            origins = generate_crop_origins(n_samples, width, height, CROP_IMAGE_SIZE, seed)
+        else:
+            origins = [self.renderer.to_raw_image_coordinates(self.start_point)]
 
-                # 랜덤한 위치 선정
-                x_rand = int(random.random() * (X_SIZE - CROP_IMAGE_SIZE - 1))
-                y_rand = int(random.random() * (Y_SIZE - CROP_IMAGE_SIZE - 1))
-                self.start_point = x_rand, y_rand
+        jobs = []
 
-                # self.start_point 설정 후 재귀
-                self.save(images)
-            
-            self.start_point = None
-            return
+        for x, y in origins:
+            # crop이 이미지 안에 들어가도록 시작 위치를 제한한다
+            x = min(max(int(x), 0), max(0, width - CROP_IMAGE_SIZE))
+            y = min(max(int(y), 0), max(0, height - CROP_IMAGE_SIZE))
 
-        x, y = self.start_point
-        cropped = []
-        
-        for image in images:
-            cropped_image = []
-            for delta_y in range(CROP_IMAGE_SIZE):
-                row = image[y + delta_y][x:x + CROP_IMAGE_SIZE]
-                cropped_image.append(row)
-            cropped.append(np.array(cropped_image))
-
-        # UUID 이름으로 crop한 파일 저장
-        uuid_string = uuid.uuid4()
-        print(uuid_string)
-        cv2.imwrite(f"sem_cropped_images/images/{uuid_string}.jpg", cropped[0])
-        cv2.imwrite(f"sem_cropped_images/segmentation-masks/{uuid_string}.jpg", cropped[1])
\ No newline at end of file
+            # UUID 이름으로 crop한 파일 저장 - 어떤 이미지의 어느 위치에서 crop했는지는 저장에 성공한 뒤 기록한다
+            file_name = f"{uuid.uuid4()}.jpg"
+            crops = [image[y:y + CROP_IMAGE_SIZE, x:x + CROP_IMAGE_SIZE] for image in images]
+
+            # crop은 화면 크기로 줄인 이미지에서 자르지만, 기록은 source_path의 원본 픽셀 좌표로 한다
+            source_x, source_y = self.renderer.from_raw_image_coordinates((x, y))
+            jobs.append((file_name, crops, (file_name, self.renderer.source_path, int(round(source_x)), int(round(source_y)))))
+
+        self.writer.submit(jobs)
+        print(f"saving {len(jobs)} cropped samples")
+
+    def close(self):
+        """남은 crop을 모두 저장하고 저장 스레드 풀을 닫는다"""
+
+        self.writer.close()
+
+def generate_crop_origins(n_samples, width, height, size=CROP_IMAGE_SIZE, seed=None):
+    """이미지 안에 들어가는 size x size crop의 시작 위치 (x, y) n_samples개를 한번에 선정한다"""
+
+    rng = np.random.default_rng(seed)
+
+    xs = rng.integers(0, max(1, width - size), n_samples)
+    ys = rng.integers(0, max(1, height - size), n_samples)
+
+    return np.stack([xs, ys], axis=1)
+
+class CropWriter:
+    """
+    crop한 이미지와 마스크 이미지를 백그라운드 스레드 풀에서 인코딩하여 저장하는 클래스
+
+    실패한 저장은 pending, close에서 정리할 때 알리고 failed에 센다
+    """
+
+    def __init__(self, workers=CROP_WRITER_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+        self.failed = 0
+
+    def submit(self, jobs):
+        """(파일 이름, [crop한 이미지, crop한 마스크 이미지], 매니페스트 행) 목록의 저장을 예약한다"""
+
+        self.collect()
+        self.futures.extend(self.executor.submit(write_crops, file_name, crops, row) for file_name, crops, row in jobs)
+
+    def collect(self):
+        """끝난 저장 작업을 목록에서 지우고, 실패한 저장을 알린다"""
+
+        remaining = []
+
+        for future in self.futures:
+            if not future.done():
+                remaining.append(future)
+            elif future.exception() is not None:
+                self.failed += 1
+                print(f"failed to save a cropped sample: {future.exception()}")
+
+        self.futures = remaining
+
+    @property
+    def pending(self):
+        """아직 저장되지 않은 crop 수"""
+
+        self.collect()
+        return len(self.futures)
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        self.collect()
+
+def write_crops(file_name, crops, row=None):
+    """
+    crop한 이미지와 마스크 이미지를 저장하고, 둘 다 저장되었다면 매니페스트에 row를 추가한다
+
+    cv2.imwrite는 GIL을 놓으므로 여러 스레드에서 동시에 저장된다. 저장에 실패하면 OSError가 발생한다.
+    """
+
+    image, mask_image = crops
+
+    for path, crop in ((f"sem_cropped_images/images/{file_name}", image), (f"sem_cropped_images/segmentation-masks/{file_name}", mask_image)):
+        if not cv2.imwrite(path, crop):
+            raise OSError(f"could not write {path}")
+
+    if row is not None:
+        append_crop_manifest([row])
+
+_manifest_lock = threading.Lock()
+
+def append_crop_manifest(rows):
+    """crop한 파일 이름, 원본 이미지 경로, 원본 이미지의 픽셀 좌표로 나타낸 crop 시작 위치를 CROP_MANIFEST_PATH에 추가한다"""
+
+    # 여러 저장 스레드에서 호출된다
+    with _manifest_lock:
+        is_new = not os.path.exists(CROP_MANIFEST_PATH)
+
+        with open(CROP_MANIFEST_PATH, "a", newline="") as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(["file", "source", "x", "y"])
+            writer.writerows(rows)
\ No newline at end of file
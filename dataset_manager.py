@@ -14,14 +14,20 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from concurrent.futures import ProcessPoolExecutor
+import csv
 from enum import Enum
+import hashlib
 import os
+import time
 import cv2
 import numpy as np
 
-from settings import LIMIT_DATASET_LOAD, TRAIN_TEST_RATIO
+from settings import CROP_IMAGE_SIZE, CROP_MANIFEST_PATH, DATASET_CACHE_PATH, DATASET_DIRECTORY, LIMIT_DATASET_LOAD, SHARD_DIRECTORY, SHUFFLE_BUFFER_SIZE, SOURCE_IMAGE_DIRECTORY, TRAIN_TEST_RATIO, X_SIZE, Y_SIZE
 
 BLUISHNESS_THRESHOLD = 25
+SHARD_INDEX_FILE = "index.csv"
+SHARD_INDEX_FIELDS = ["shard", "offset", "file", "source", "x", "y", "split"]
 
 class ImageType(Enum):
   IMAGE = 1  # Raw SEM images
@@ -40,29 +46,72 @@ class ImageType(Enum):
 
     return types
 
+def extract_masks_from_array(mask_image):
+  """마스크 이미지 배열(BGR)로부터 0과 1로 이루어진 uint8 마스크를 추출하는 커널"""
+
+  channels = mask_image.astype("int16")
+
+  # B - R - G 가 25보다 큰 픽셀만 1로 레이블, 나머지는 0 (임계값이 양수이므로 음수를 0으로 자를 필요가 없다)
+  bluishness = channels[:, :, 0] - channels[:, :, 1] - channels[:, :, 2]
+
+  return (bluishness > BLUISHNESS_THRESHOLD).astype("uint8")
+
 def extract_masks(mask_image_path):
   """마스크 이미지로부터 마스크를 추출하는 함수"""
-  
-  mask_image = cv2.imread(mask_image_path)
 
-  blues = mask_image[:, :, 0].copy().astype("int16")
-  greens = mask_image[:, :, 1].copy().astype("int16")
-  reds = mask_image[:, :, 2].copy().astype("int16")
+  return extract_masks_from_array(cv2.imread(mask_image_path))
 
-  # B - R - G 가 25보다 큰 픽셀만 1로 레이블, 나머지는 0
+def mask_output_path(mask_image_path):
+  """마스크 이미지 경로에 대응하는 마스크 저장 경로"""
 
-  bluishness = np.vectorize(lambda x: 0 if x < 0 else x)(blues - greens - reds)
-  maskified = np.vectorize(lambda x: 1 if x > BLUISHNESS_THRESHOLD else 0)(bluishness)
-  
-  return maskified
+  return mask_image_path.replace("/segmentation-masks/", "/masks/")
+
+def is_mask_up_to_date(mask_image_path):
+  """저장된 마스크가 마스크 이미지보다 최신이라면 True"""
+
+  mask_path = mask_output_path(mask_image_path)
+
+  return os.path.exists(mask_path) and os.path.getmtime(mask_path) >= os.path.getmtime(mask_image_path)
+
+def convert_mask(mask_image_path):
+  """마스크 이미지 하나를 마스크로 변환하여 저장"""
+
+  mask_path = mask_output_path(mask_image_path)
+  os.makedirs(os.path.dirname(mask_path), exist_ok=True)
 
-def create_masks_from_image(raw_images):
-  """마스크 이미지가 담겨져 있는 폴더에서 모든 이미지를 마스크로 변환하여 새로운 폴더에 저장"""
+  return cv2.imwrite(mask_path, extract_masks(mask_image_path))
+
+def create_masks_from_image(raw_images, workers=None, force=False):
+  """
+  마스크 이미지가 담겨져 있는 폴더에서 모든 이미지를 마스크로 변환하여 새로운 폴더에 저장
+
+  이미 최신인 마스크는 건너뛰고 (force가 True라면 모두 변환), 나머지는 프로세스 풀에 나누어 변환한다.
+  변환한 개수, 건너뛴 개수, 걸린 시간을 반환한다.
+  """
 
   images, masks = raw_images
 
-  for mask in masks:
-    cv2.imwrite(mask.replace("/segmentation-masks/", "/masks/"), extract_masks(mask))
+  pending = [str(mask) for mask in masks if force or not is_mask_up_to_date(str(mask))]
+  skipped = len(masks) - len(pending)
+
+  start = time.perf_counter()
+
+  if workers == 1 or len(pending) <= 1:
+    results = list(map(convert_mask, pending))
+  else:
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(pending) // (4 * workers))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(convert_mask, pending, chunksize=chunksize))
+
+  elapsed = time.perf_counter() - start
+  converted = sum(1 for result in results if result)
+
+  throughput = converted / elapsed if elapsed > 0 else 0.0
+  print(f"converted {converted} masks, skipped {skipped} up to date in {elapsed:.2f}s ({throughput:.1f} images/s)")
+
+  return converted, skipped, elapsed
 
 def load_image_paths(dataset_directory, bitmask):
   """주어진 데이터셋 디렉토리에서 원하는 데이터의 경로의 리스트를 반환"""
@@ -110,4 +159,240 @@ def load_dataset():
   test_images, train_images = split_data_with_ratio(normalize_image(images), TRAIN_TEST_RATIO)
   test_masks, train_masks = split_data_with_ratio(masks, TRAIN_TEST_RATIO)
 
-  return test_images, train_images, test_masks, train_masks
\ No newline at end of file
+  return test_images, train_images, test_masks, train_masks
+
+def make_tf_dataset(image_paths, mask_paths, batch_size=64, shuffle=True, cache_path=None):
+  """
+  이미지, 마스크 경로로부터 스트리밍 tf.data 파이프라인을 만든다
+
+  병렬로 디코딩한 uint8 이미지를 cache_path에 캐시하고 (None이면 캐시하지 않는다, ""이면 메모리에 캐시),
+  셔플 버퍼에서 섞은 뒤 배치마다 0과 1사이로 정규화하고 미리 불러온다.
+  파일 캐시는 dataset_cache_path로 데이터셋마다 다른 이름을 쓰므로, 크롭이 바뀌면 예전 캐시를 읽지 않는다.
+  """
+
+  import tensorflow as tf
+
+  def decode(image_path, mask_path):
+    # cv2.imread와 같이 BGR 순서로 맞춘다
+    image = tf.io.decode_jpeg(tf.io.read_file(image_path), channels=3)[:, :, ::-1]
+    mask = tf.io.decode_jpeg(tf.io.read_file(mask_path), channels=3)
+    return image, mask
+
+  def normalize(image, mask):
+    return tf.cast(image, tf.float32) / 255.0, tf.cast(mask, tf.float32)
+
+  dataset = tf.data.Dataset.from_tensor_slices((list(map(str, image_paths)), list(map(str, mask_paths))))
+  dataset = dataset.map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+
+  if cache_path is not None:
+    dataset = dataset.cache(dataset_cache_path(cache_path, image_paths, mask_paths) if cache_path else cache_path)
+
+  if shuffle:
+    dataset = dataset.shuffle(SHUFFLE_BUFFER_SIZE, reshuffle_each_iteration=True)
+
+  dataset = dataset.batch(batch_size)
+  dataset = dataset.map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
+
+  return dataset.prefetch(tf.data.AUTOTUNE)
+
+def dataset_cache_path(cache_path, image_paths, mask_paths):
+  """
+  tf.data 파일 캐시의 경로 - 경로 목록, 파일 크기와 수정 시각, CROP_IMAGE_SIZE의 해시를 붙인다
+
+  tf.data는 캐시 파일이 있으면 원본이 바뀌어도 그대로 읽으므로, 크롭을 추가하거나 다시 만들면 다른 캐시를 쓰게 한다
+  """
+
+  digest = hashlib.sha1(f"{CROP_IMAGE_SIZE}".encode())
+
+  for path in sorted(map(str, [*image_paths, *mask_paths])):
+    stat = os.stat(path)
+    digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+
+  return f"{cache_path}-{digest.hexdigest()[:16]}"
+
+def load_streaming_dataset(batch_size=64, dataset_directory=DATASET_DIRECTORY, cache_path=DATASET_CACHE_PATH):
+  """
+  load_dataset과 같은 비율로 train_test_split을 진행하되, 전체 데이터셋을 메모리에 올리지 않는 스트리밍 파이프라인으로 반환
+
+  LIMIT_DATASET_LOAD 제한 없이 모든 이미지를 사용한다
+  """
+
+  image_paths, mask_paths = load_image_paths(dataset_directory, ImageType.IMAGE.value + ImageType.MASK.value)
+  test_image_paths, train_image_paths = split_data_with_ratio(image_paths, TRAIN_TEST_RATIO)
+  test_mask_paths, train_mask_paths = split_data_with_ratio(mask_paths, TRAIN_TEST_RATIO)
+
+  test_cache_path = train_cache_path = None
+  if cache_path is not None:
+    test_cache_path, train_cache_path = f"{cache_path}-test", f"{cache_path}-train"
+
+  test_dataset = make_tf_dataset(test_image_paths, test_mask_paths, batch_size, False, test_cache_path)
+  train_dataset = make_tf_dataset(train_image_paths, train_mask_paths, batch_size, True, train_cache_path)
+
+  return test_dataset, train_dataset, (train_image_paths, train_mask_paths)
+
+def load_crop_manifest(manifest_path=CROP_MANIFEST_PATH):
+  """crop 기록을 {파일 이름: (원본 이미지 경로, x, y)} 딕셔너리로 읽는다"""
+
+  if not os.path.exists(manifest_path):
+    return {}
+
+  with open(manifest_path, newline="") as f:
+    return {row["file"]: (row["source"], int(row["x"]), int(row["y"])) for row in csv.DictReader(f)}
+
+def shard_file_paths(shard_directory, shard):
+  """shard 번호에 해당하는 이미지, 마스크 파일 경로"""
+
+  return os.path.join(shard_directory, f"shard-{shard:05d}-images.npy"), os.path.join(shard_directory, f"shard-{shard:05d}-masks.npy")
+
+class ShardDataset:
+  """
+  shard_packer로 묶은 shard를 메모리 매핑하여 샘플을 복사 없이 읽는 데이터셋
+
+  dataset[i]는 (128, 128, 3) BGR 이미지와 (128, 128) 마스크의 읽기 전용 뷰를 반환하고, as_tf_dataset은 학습용 배치를 만든다.
+  index에는 각 샘플의 shard, offset, 파일 이름, 원본 이미지, crop 위치, split이 담겨 있다.
+  """
+
+  def __init__(self, shard_directory=SHARD_DIRECTORY, split=None):
+    with open(os.path.join(shard_directory, SHARD_INDEX_FILE), newline="") as f:
+      self.index = [row for row in csv.DictReader(f) if split is None or row["split"] == split]
+
+    self.shards = np.array([int(row["shard"]) for row in self.index], dtype="intp")
+    self.offsets = np.array([int(row["offset"]) for row in self.index], dtype="intp")
+
+    # shard 파일은 메모리 매핑만 하고, 실제로 읽는 것은 샘플에 접근할 때이다
+    self.images, self.masks = {}, {}
+    for shard in np.unique(self.shards):
+      image_path, mask_path = shard_file_paths(shard_directory, shard)
+      self.images[shard] = np.load(image_path, mmap_mode="r")
+      self.masks[shard] = np.load(mask_path, mmap_mode="r")
+
+  def __len__(self):
+    return len(self.index)
+
+  def __getitem__(self, i):
+    shard, offset = self.shards[i], self.offsets[i]
+    return self.images[shard][offset], self.masks[shard][offset]
+
+  def as_tf_dataset(self, batch_size=64, shuffle=True, seed=None):
+    """
+    shard에서 샘플을 읽어 make_tf_dataset과 같은 형태로 배치를 만드는 tf.data 파이프라인
+
+    epoch마다 샘플 순서를 새로 섞으며 (shuffle), 샘플은 메모리 매핑된 shard에서 필요할 때 읽는다.
+    이미지는 0과 1사이로 정규화하고, 마스크는 학습 데이터와 같이 3채널로 복제한다.
+    """
+
+    import tensorflow as tf
+
+    size = CROP_IMAGE_SIZE
+    rng = np.random.default_rng(seed)
+
+    def generate():
+      order = rng.permutation(len(self)) if shuffle else range(len(self))
+      for i in order:
+        image, mask = self[i]
+        yield np.array(image), np.repeat(mask[:, :, np.newaxis], 3, axis=2)
+
+    def normalize(image, mask):
+      return tf.cast(image, tf.float32) / 255.0, tf.cast(mask, tf.float32)
+
+    signature = (tf.TensorSpec((size, size, 3), tf.uint8), tf.TensorSpec((size, size, 3), tf.uint8))
+
+    dataset = tf.data.Dataset.from_generator(generate, output_signature=signature)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def load_source_images(source_directory=SOURCE_IMAGE_DIRECTORY, size=(X_SIZE, Y_SIZE)):
+  """
+  원본 SEM 이미지와 마스크 이미지를 읽어서 (이미지 목록, 마스크 목록)으로 반환
+
+  뷰어에서 crop할 때와 같은 배율이 되도록 size로 크기를 조정하며 (None이면 원본 크기),
+  마스크는 파란 선이 흐려지지 않도록 최근접 보간으로 조정한 뒤 0과 1로 추출한다
+  """
+
+  image_paths, mask_image_paths = load_image_paths(source_directory, ImageType.IMAGE.value + ImageType.MASK_IMAGE.value)
+  images, masks = [], []
+
+  for image_path, mask_image_path in zip(image_paths, mask_image_paths):
+    image, mask_image = cv2.imread(str(image_path)), cv2.imread(str(mask_image_path))
+
+    if size is not None:
+      image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+      mask_image = cv2.resize(mask_image, size, interpolation=cv2.INTER_NEAREST)
+
+    images.append(image)
+    masks.append(extract_masks_from_array(mask_image))
+
+  return images, masks
+
+class RandomCropSampler:
+  """
+  전체 크기 SEM 이미지와 마스크를 메모리에 두고, 배치마다 무작위 crop_size 창을 뽑아 학습 데이터를 만드는 클래스
+
+  crop을 디스크에 저장하지 않으므로 메모리는 원본 이미지 수에만 비례하고, 매 배치마다 새로운 crop이 만들어진다.
+  augment가 True라면 crop마다 무작위로 뒤집고 90도 단위로 회전한다.
+  """
+
+  def __init__(self, images, masks, crop_size=CROP_IMAGE_SIZE, augment=True, seed=None):
+    self.images = images
+    self.masks = masks
+    self.crop_size = crop_size
+    self.augment = augment
+    self.rng = np.random.default_rng(seed)
+
+    # 가능한 crop 위치의 수에 비례하여 원본 이미지를 고른다
+    areas = np.array([(image.shape[0] - crop_size + 1) * (image.shape[1] - crop_size + 1) for image in images], dtype="float64")
+    if len(areas) == 0 or np.any(areas <= 0):
+      raise ValueError(f"every source image must be at least {crop_size}x{crop_size}")
+
+    self.weights = areas / areas.sum()
+
+  def sample(self, batch_size):
+    """(batch_size, crop_size, crop_size, 3) 정규화된 이미지와 같은 크기의 0, 1 마스크를 반환"""
+
+    size = self.crop_size
+    sources = self.rng.choice(len(self.images), batch_size, p=self.weights)
+    rotations = self.rng.integers(0, 4, batch_size)
+    flips = self.rng.integers(0, 2, batch_size)
+
+    images = np.empty((batch_size, size, size, 3), dtype="uint8")
+    masks = np.empty((batch_size, size, size), dtype="uint8")
+
+    for i, source in enumerate(sources):
+      height, width = self.masks[source].shape
+      x = self.rng.integers(0, width - size + 1)
+      y = self.rng.integers(0, height - size + 1)
+
+      image = self.images[source][y:y + size, x:x + size]
+      mask = self.masks[source][y:y + size, x:x + size]
+
+      if self.augment:
+        image, mask = np.rot90(image, rotations[i]), np.rot90(mask, rotations[i])
+        if flips[i]:
+          image, mask = image[:, ::-1], mask[:, ::-1]
+
+      images[i] = image
+      masks[i] = mask
+
+    # 학습 데이터와 같이 마스크는 3채널로 복제한다
+    return normalize_image(images), np.repeat(masks[:, :, :, np.newaxis], 3, axis=3).astype("float32")
+
+  def as_tf_dataset(self, batch_size=64):
+    """매 배치마다 새로 crop하는 무한 tf.data 파이프라인"""
+
+    import tensorflow as tf
+
+    size = self.crop_size
+
+    def generate():
+      while True:
+        yield self.sample(batch_size)
+
+    signature = (tf.TensorSpec((batch_size, size, size, 3), tf.float32), tf.TensorSpec((batch_size, size, size, 3), tf.float32))
+
+    return tf.data.Dataset.from_generator(generate, output_signature=signature).prefetch(tf.data.AUTOTUNE)
+
+if __name__ == "__main__":
+  # 데이터셋의 모든 마스크 이미지를 마스크로 변환
+  create_masks_from_image(load_image_paths("sem_cropped_images", ImageType.IMAGE.value + ImageType.MASK_IMAGE.value))
@@ -0,0 +1,76 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+from settings import IDLE_MAX_WAIT_MS, LOOP_STATS_INTERVAL, TARGET_FPS
+
+class FramePacer:
+    """
+    메인 루프의 입력 대기 시간을 정하는 클래스
+
+    활동(입력, 화면 변경, 분석 진행)이 있으면 목표 프레임 속도에 맞춰 남은 시간만큼만 기다리고,
+    활동이 없으면 대기 시간을 두 배씩 늘려 max_idle_wait_ms까지 쉰다. 프레임 시간과 대기 비율도 측정한다.
+    """
+
+    def __init__(self, target_fps=TARGET_FPS, max_idle_wait_ms=IDLE_MAX_WAIT_MS, stats_interval=LOOP_STATS_INTERVAL):
+        self.frame_ms = 1000.0 / target_fps
+        self.max_idle_wait_ms = max_idle_wait_ms
+        self.stats_interval = stats_interval
+
+        self.wait_ms = self.frame_ms
+        self.tick_start = time.perf_counter()
+
+        # 측정 구간 통계
+        self.window_start = self.tick_start
+        self.frames = 0
+        self.work_seconds = 0.0
+        self.idle_seconds = 0.0
+        self.summary = None
+
+    def tick(self, active, idle_seconds):
+        """
+        한 프레임이 끝났을 때 호출한다 - idle_seconds는 이번 프레임에서 입력을 기다린 시간
+
+        측정 구간이 끝나면 True를 반환하며, 이때 summary가 갱신된다
+        """
+
+        now = time.perf_counter()
+        work_seconds = max(0.0, now - self.tick_start - idle_seconds)
+        self.tick_start = now
+
+        # 활동이 있으면 남은 프레임 시간만큼만, 없으면 점점 길게 기다린다
+        if active:
+            self.wait_ms = max(1.0, self.frame_ms - work_seconds * 1000)
+        else:
+            self.wait_ms = min(self.max_idle_wait_ms, max(self.frame_ms, self.wait_ms * 2))
+
+        self.frames += 1
+        self.work_seconds += work_seconds
+        self.idle_seconds += idle_seconds
+
+        elapsed = now - self.window_start
+        if elapsed < self.stats_interval:
+            return False
+
+        self.summary = f"{self.work_seconds * 1000 / self.frames:.1f}ms/frame, {self.frames / elapsed:.0f} fps, idle {self.idle_seconds / elapsed:.0%}"
+
+        self.window_start = now
+        self.frames = 0
+        self.work_seconds = 0.0
+        self.idle_seconds = 0.0
+
+        return True
@@ -15,6 +15,7 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import math
+import numpy as np
 from settings import X_SIZE, Y_SIZE
 
 
@@ -44,8 +45,8 @@ class LinearGraph:
         
         return (a, b)
     
-    def boundary_intercepts(self):
-        """이 그래프와 화면 가장자리의 교점을 반환"""
+    def boundary_intercepts(self, width=X_SIZE, height=Y_SIZE):
+        """이 그래프와 width x height 영역 가장자리의 교점을 반환"""
 
         a, b = self.linear_graph_coeffs()
         intercepts = []
@@ -55,10 +56,10 @@ class LinearGraph:
         else:
             intercepts.append((0, int(1/b)))
         
-        if b == 0 or 1 - a * X_SIZE > Y_SIZE * b:
-            intercepts.append((int((1 - b * Y_SIZE) / a), Y_SIZE))
+        if b == 0 or 1 - a * width > height * b:
+            intercepts.append((int((1 - b * height) / a), height))
         else:
-            intercepts.append((X_SIZE, int((1 - a * X_SIZE) / b)))
+            intercepts.append((width, int((1 - a * width) / b)))
 
         return list(set(intercepts))
 
@@ -69,6 +70,26 @@ class LinearGraph:
             return 1000  # 근사
         else:
             return - 1.0 / self.gradient
-        
-        
-        
+
+def perpendicular_gradient_from_angle(angle):
+    """화면 기준으로 수평선에서 반시계 방향으로 angle도 기울어진 직선에 수직한 기울기를 cv2 좌표계로 반환"""
+
+    radians = math.radians(angle)
+
+    # cv2 좌표계는 y축이 아래를 향하므로 y 성분의 부호를 바꾼다
+    return LinearGraph((0.0, 0.0), (math.cos(radians), -math.sin(radians))).perpendicular_gradient()
+
+def perpendicular_gradients_from_angles(angles):
+    """perpendicular_gradient_from_angle을 여러 각도에 대해 한번에 계산하여 배열로 반환"""
+
+    radians = np.radians(np.asarray(angles, dtype="float64"))
+
+    with np.errstate(divide="ignore"):
+        gradients = -np.sin(radians) / np.cos(radians)
+        return np.where(gradients == 0, 1000.0, -1.0 / gradients)
+
+def angle_from_perpendicular_gradient(gradient):
+    """perpendicular_gradient_from_angle의 역함수 - 0 이상 180 미만의 각도(도)를 반환"""
+
+    return math.degrees(math.atan2(1.0, gradient)) % 180.0
+
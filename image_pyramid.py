@@ -0,0 +1,195 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import math
+import threading
+import cv2
+import numpy as np
+
+from image_source import as_image_source
+from settings import PYRAMID_TILE_SIZE, TILE_CACHE_BYTES
+
+# 피라미드의 level 1을 만들 때 원본에서 한번에 읽는 행 수 (짝수)
+PYRAMID_BUILD_ROWS = 1024
+
+class TileCache:
+    """가장 오래 쓰이지 않은 타일부터 버리는 LRU 타일 캐시 - 여러 피라미드가 함께 쓰며, 타일의 전체 크기를 max_bytes 이하로 유지한다"""
+
+    def __init__(self, max_bytes=TILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """key의 타일을 반환한다 - 없다면 build()로 만들어 넣는다"""
+
+        tile = self.tiles.get(key)
+
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+        tile = build()
+        self.misses += 1
+
+        self.tiles[key] = tile
+        self.nbytes += tile.nbytes
+
+        while self.nbytes > self.max_bytes and len(self.tiles) > 1:
+            self.nbytes -= self.tiles.popitem(last=False)[1].nbytes
+
+        return tile
+
+class ImagePyramid:
+    """
+    이미지의 다해상도 타일 피라미드
+
+    level 0은 원본 해상도, level k는 2^k배 축소한 이미지이며 각 level은 tile_size 정사각형 타일로 나뉜다.
+    level 0 타일은 확대했을 때 ImageSource에서 그 영역만 읽어 TileCache에 보관한다. level 1 이상은 처음 한번
+    원본을 띠 단위로 읽어 미리 만들어 두며 (원본 크기의 1/3 정도), 캐시를 거치지 않으므로 축소한 화면은 원본을 다시 읽지 않는다.
+    background가 True라면 미리 만드는 작업을 백그라운드 스레드에서 하며, 끝나기 전에는 compose가 None을 반환할 수 있다.
+    close()를 부르면 만드는 작업은 다음 띠에서 멈춘다.
+    """
+
+    def __init__(self, source, cache: TileCache, tile_size=PYRAMID_TILE_SIZE, background=True):
+        self.source = as_image_source(source)
+        self.cache = cache
+        self.tile_size = tile_size
+        self.width, self.height = self.source.width, self.source.height
+
+        # 가장 위 level은 타일 하나에 들어간다
+        self.levels = 1
+        while max(self.width, self.height) > tile_size * 2 ** (self.levels - 1):
+            self.levels += 1
+
+        # level 1 이상의 축소 이미지 (만들어지기 전에는 None)
+        self.level_images = [None] * self.levels
+        self.ready = threading.Event()
+        self.stop_event = threading.Event()
+
+        # 데몬 스레드가 cv2 호출 중에 종료되면 프로세스가 비정상 종료되므로, 종료할 때 만드는 작업이 끝나기를 기다린다
+        # (close()로 멈추면 띠 하나만 기다린다)
+        if background and self.levels > 1:
+            threading.Thread(target=self.build_levels).start()
+        else:
+            self.build_levels()
+
+    def build_levels(self):
+        """level 1 이상을 아래에서부터 만든다 - 원본은 level 1을 만들 때 한번만 읽는다"""
+
+        if self.levels > 1:
+            height, width = self.level_shape(1)
+            level = np.zeros((height, width, 3), dtype="uint8")
+
+            for y in range(0, self.height, PYRAMID_BUILD_ROWS):
+                if self.stop_event.is_set():
+                    return
+
+                strip = self.source.read_region(0, y, self.width, PYRAMID_BUILD_ROWS)
+                level[y // 2:y // 2 + (strip.shape[0] + 1) // 2] = half_size(strip)
+
+            self.level_images[1] = level
+
+        for level in range(2, self.levels):
+            if self.stop_event.is_set():
+                return
+
+            self.level_images[level] = half_size(self.level_images[level - 1])
+
+        self.ready.set()
+
+    def close(self):
+        """백그라운드에서 만드는 작업을 멈춘다 - 멈춘 뒤에는 ready가 설정되지 않는다"""
+
+        self.stop_event.set()
+
+    def level_shape(self, level):
+        """level 이미지의 (높이, 너비)"""
+
+        return math.ceil(self.height / 2 ** level), math.ceil(self.width / 2 ** level)
+
+    def tile(self, level, tile_x, tile_y):
+        """level의 (tile_x, tile_y)번째 타일 - 가장자리 타일은 tile_size보다 작을 수 있다"""
+
+        if level == 0:
+            return self.cache.get((id(self), tile_x, tile_y), lambda: self.build_tile(tile_x, tile_y))
+
+        size = self.tile_size
+        return self.level_images[level][tile_y * size:(tile_y + 1) * size, tile_x * size:(tile_x + 1) * size]
+
+    def build_tile(self, tile_x, tile_y):
+        size = self.tile_size
+        return self.source.read_region(tile_x * size, tile_y * size, size, size)
+
+    def compose(self, x, y, zoom, width, height, image_width=None, image_height=None):
+        """
+        화면에 보이는 영역만 합성하여 (height, width, 3) 이미지로 반환 - 필요한 축소 이미지가 아직 만들어지는 중이라면 None
+
+        (x, y)는 화면 왼쪽 위에 해당하는 이미지 좌표, zoom은 이미지 한 픽셀당 화면 픽셀 수이다.
+        이미지 좌표계의 크기 (image_width, image_height)가 피라미드와 다르다면 (축소된 마스크 이미지 등) 비율을 맞춘다.
+        """
+
+        scale_x = self.width / (image_width or self.width)
+        scale_y = self.height / (image_height or self.height)
+        zoom_x, zoom_y = zoom / scale_x, zoom / scale_y
+
+        # 화면 한 픽셀에 원본 픽셀이 2^k개 이상 들어가는 가장 높은 level을 고른다
+        level = min(self.levels - 1, max(0, int(math.floor(math.log2(1.0 / min(zoom_x, zoom_y))))))
+        factor = 2 ** level
+
+        # level 좌표계로 변환
+        level_x, level_y = x * scale_x / factor, y * scale_y / factor
+        level_zoom_x, level_zoom_y = zoom_x * factor, zoom_y * factor
+        level_height, level_width = self.level_shape(level)
+
+        size = self.tile_size
+        first_x = max(0, int(math.floor(level_x / size)))
+        first_y = max(0, int(math.floor(level_y / size)))
+        last_x = min(math.ceil(level_width / size), int(math.ceil((level_x + width / level_zoom_x) / size))) - 1
+        last_y = min(math.ceil(level_height / size), int(math.ceil((level_y + height / level_zoom_y) / size))) - 1
+
+        if last_x < first_x or last_y < first_y:
+            return np.zeros((height, width, 3), dtype="uint8")
+
+        # 축소 이미지가 아직 만들어지지 않았다
+        if level > 0 and self.level_images[level] is None:
+            return None
+
+        # 보이는 타일만 붙인다
+        mosaic = np.zeros(((last_y - first_y + 1) * size, (last_x - first_x + 1) * size, 3), dtype="uint8")
+        for tile_y in range(first_y, last_y + 1):
+            for tile_x in range(first_x, last_x + 1):
+                tile = self.tile(level, tile_x, tile_y)
+                top, left = (tile_y - first_y) * size, (tile_x - first_x) * size
+                mosaic[top:top + tile.shape[0], left:left + tile.shape[1]] = tile
+
+        # 붙인 타일을 화면 좌표로 옮긴다 (많이 확대했다면 픽셀이 보이도록 최근접 보간)
+        matrix = np.float32([
+            [level_zoom_x, 0, (first_x * size - level_x) * level_zoom_x],
+            [0, level_zoom_y, (first_y * size - level_y) * level_zoom_y],
+        ])
+        interpolation = cv2.INTER_NEAREST if min(level_zoom_x, level_zoom_y) >= 2 else cv2.INTER_LINEAR
+
+        return cv2.warpAffine(mosaic, matrix, (width, height), flags=interpolation, borderMode=cv2.BORDER_CONSTANT)
+
+def half_size(image):
+    """가로, 세로를 절반으로 (홀수라면 올림) 줄인다"""
+
+    return cv2.resize(image, ((image.shape[1] + 1) // 2, (image.shape[0] + 1) // 2), interpolation=cv2.INTER_AREA)
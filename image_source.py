@@ -0,0 +1,152 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import cv2
+import numpy as np
+
+import analysis_cache
+
+RAW_EXTENSIONS = (".raw", ".bin")
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+class ImageSource:
+    """
+    원본 해상도 이미지를 필요한 영역만 읽어오는 클래스
+
+    array는 (H, W) 또는 (H, W, C) 배열(np.memmap 등)이며, read_region은 항상 (h, w, 3) uint8 BGR 배열의 복사본을 반환한다.
+    메모리 매핑된 배열이라면 읽은 영역만 메모리에 올라온다.
+    """
+
+    def __init__(self, array, rgb=False, path=None):
+        self.array = array
+        self.rgb = rgb
+        self.path = path
+
+        self.height, self.width = array.shape[:2]
+        self.shape = (self.height, self.width, 3)
+
+    def to_bgr(self, region):
+        """읽어온 영역을 uint8 BGR로 변환한다"""
+
+        region = np.asarray(region)
+
+        if region.dtype != np.uint8:
+            # 16비트 등은 자료형의 최댓값 기준으로 8비트로 줄인다
+            region = (region.astype("float32") * (255.0 / np.iinfo(region.dtype).max)).astype("uint8") if np.issubdtype(region.dtype, np.integer) else np.clip(region, 0, 255).astype("uint8")
+
+        if region.ndim == 2:
+            return np.repeat(region[:, :, np.newaxis], 3, axis=2)
+
+        region = region[:, :, :3]
+
+        return np.ascontiguousarray(region[:, :, ::-1]) if self.rgb else np.array(region)
+
+    def read_region(self, x, y, width, height):
+        """(x, y)에서 시작하는 width x height 영역을 읽는다 - 이미지 밖은 잘린다"""
+
+        return self.to_bgr(self.array[max(0, y):y + height, max(0, x):x + width])
+
+    def thumbnail(self, width, height):
+        """화면에 보여줄 width x height 축소 이미지 - 메모리 매핑된 이미지도 전체를 읽지 않도록 간격을 두고 읽은 뒤 줄인다"""
+
+        step_y, step_x = max(1, self.height // (height * 2)), max(1, self.width // (width * 2))
+
+        return cv2.resize(self.to_bgr(self.array[::step_y, ::step_x]), (width, height), interpolation=cv2.INTER_AREA)
+
+    def digest(self):
+        """
+        분석 캐시 키로 쓰는 내용 해시 - 파일이라면 파일 내용을, 아니라면 배열 내용을 해시한다
+
+        같은 raw 파일도 다른 크기, 자료형, 채널 순서로 읽으면 다른 이미지이므로, 파일이라면 읽은 방식도 함께 해시한다.
+        """
+
+        if self.path is not None:
+            read_parameters = f"{self.array.shape}{np.dtype(self.array.dtype)}{self.rgb}"
+            return hashlib.sha1(f"{analysis_cache.file_digest(self.path)}{read_parameters}".encode()).hexdigest()
+
+        return analysis_cache.image_digest(np.asarray(self.array))
+
+    def __array__(self, dtype=None, copy=None):
+        image = self.read_region(0, 0, self.width, self.height)
+        return image if dtype is None else image.astype(dtype)
+
+def open_image(path, shape=None, dtype="uint8"):
+    """
+    이미지 파일을 ImageSource로 연다
+
+    .npy는 np.load(mmap_mode="r"), .raw/.bin은 shape (H, W) 또는 (H, W, C)와 dtype을 주어 np.memmap으로,
+    압축되지 않은 TIFF는 tifffile.memmap으로 (tifffile이 설치되어 있다면) 메모리 매핑하여 연다.
+    .raw/.bin의 shape이 주어지지 않으면 옆에 있는 "<파일 이름>.json" ({"shape": [H, W, C], "dtype": "uint16"})을 읽는다.
+    그 밖의 파일은 cv2.imread로 전체를 읽는다.
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == ".npy":
+        return ImageSource(np.load(path, mmap_mode="r"), path=path)
+
+    if extension in RAW_EXTENSIONS:
+        if shape is None:
+            shape, dtype = read_raw_sidecar(path)
+        return ImageSource(np.memmap(path, dtype=dtype, mode="r", shape=tuple(shape)), path=path)
+
+    if extension in TIFF_EXTENSIONS:
+        try:
+            import tifffile
+        except ImportError:
+            tifffile = None
+
+        if tifffile is not None:
+            try:
+                return ImageSource(tifffile.memmap(path, mode="r"), rgb=True, path=path)
+            except ValueError:
+                # 압축된 TIFF는 메모리 매핑할 수 없으므로 전체를 읽는다
+                return ImageSource(tifffile.imread(path), rgb=True, path=path)
+
+    image = cv2.imread(path)
+    if image is None:
+        raise ValueError(f"could not read the image: {path}")
+
+    return ImageSource(image, path=path)
+
+def raw_sidecar_path(path):
+    """.raw/.bin 이미지의 크기와 자료형을 적어두는 파일의 경로"""
+
+    return f"{path}.json"
+
+def read_raw_sidecar(path):
+    """raw 이미지 옆의 JSON 파일에서 (shape, dtype)을 읽는다 (dtype이 없다면 uint8) - 파일이 없다면 ValueError"""
+
+    try:
+        with open(raw_sidecar_path(path)) as f:
+            description = json.load(f)
+    except FileNotFoundError:
+        raise ValueError(f"the shape of a raw image must be given (or written to {raw_sidecar_path(path)})")
+
+    return tuple(description["shape"]), description.get("dtype", "uint8")
+
+def parse_shape(text):
+    """"12000,16000" 또는 "12000,16000,3" 형태의 (높이, 너비[, 채널])를 튜플로 바꾼다"""
+
+    return tuple(int(value) for value in text.split(","))
+
+def as_image_source(image):
+    """배열이라면 ImageSource로 감싸고, 이미 ImageSource라면 그대로 반환"""
+
+    return image if isinstance(image, ImageSource) else ImageSource(image)
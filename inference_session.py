@@ -0,0 +1,166 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import numpy as np
+
+from settings import CROP_IMAGE_SIZE, INFERENCE_BACKEND, INFERENCE_BATCH_SIZE, MODEL_PATH, TFLITE_MODEL_PATH, TFLITE_THREADS
+
+class InferenceSession:
+    """
+    사전 학습된 모델을 한번만 불러와서 계속 재사용하는 추론 세션
+
+    입력 크기를 batch_size로 고정한 tf.function으로 추론하므로, 분석을 반복해도 그래프를 다시 만들지 않는다
+    """
+
+    backend = "keras"
+
+    def __init__(self, model_path=MODEL_PATH, batch_size=INFERENCE_BATCH_SIZE, model=None):
+        # 텐서플로는 처음 세션을 만들 때 불러온다
+        import tensorflow as tf
+
+        # 메모리에서 만든 모델을 받았다면 모델 파일이 없다 (분석 캐시를 쓰지 않는다)
+        self.model_path = model_path if model is None else None
+        self.batch_size = batch_size
+        self.input_shape = (CROP_IMAGE_SIZE, CROP_IMAGE_SIZE, 3)
+
+        # 모델은 세션이 만들어질 때 한번만 불러온다
+        self.model = model if model is not None else tf.keras.models.load_model(model_path)
+        self.output_channels = self.model.output_shape[-1]
+
+        self._predict_batch = tf.function(
+            lambda batch: self.model(batch, training=False),
+            input_signature=[tf.TensorSpec((batch_size, *self.input_shape), tf.float32)],
+        )
+
+        self.warmup()
+
+    def warmup(self):
+        """빈 배치로 한번 추론하여 그래프를 미리 만들어 둔다"""
+
+        self.predict_batch(np.zeros((self.batch_size, *self.input_shape), dtype="float32"))
+
+    def predict_batch(self, batch: np.ndarray):
+        """크기가 batch_size로 고정된 배치 하나를 추론한다"""
+
+        import tensorflow as tf
+
+        return self._predict_batch(tf.constant(batch)).numpy()
+
+    def predict(self, images, progress=None):
+        """
+        (N, 128, 128, 3) 이미지를 batch_size 단위로 추론하여 (N, 128, 128, C) 예측을 반환
+
+        progress가 주어지면 배치마다 progress("tiles", 추론한 타일 수, 전체 타일 수)를 호출한다
+        """
+
+        images = np.asarray(images, dtype="float32")
+        predicts = np.zeros((len(images), *self.input_shape[:2], self.output_channels), dtype="float32")
+
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start:start + self.batch_size]
+            n = len(batch)
+
+            # 마지막 배치는 0으로 채워서 크기를 고정한다
+            if n < self.batch_size:
+                batch = np.concatenate([batch, np.zeros((self.batch_size - n, *self.input_shape), dtype="float32")])
+
+            predicts[start:start + n] = self.predict_batch(batch)[:n]
+
+            if progress is not None:
+                progress("tiles", start + n, len(images))
+
+        return predicts
+
+class TFLiteSession(InferenceSession):
+    """
+    tflite_export로 변환한 TFLite 모델로 추론하는 세션 - GPU가 없는 컴퓨터에서 InferenceSession 대신 사용한다
+
+    입력 텐서의 크기를 batch_size로 고정해 두고 재사용하며, 정수 입출력 모델이라면 양자화/역양자화를 대신 해준다.
+    인터프리터는 스레드 안전하지 않으므로, 세션을 여러 스레드에서 함께 쓰더라도 한번에 하나의 배치만 추론한다.
+    """
+
+    backend = "tflite"
+
+    def __init__(self, model_path=TFLITE_MODEL_PATH, batch_size=INFERENCE_BATCH_SIZE, num_threads=TFLITE_THREADS):
+        import tensorflow as tf
+
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.input_shape = (CROP_IMAGE_SIZE, CROP_IMAGE_SIZE, 3)
+
+        self.interpreter_lock = threading.Lock()
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads or os.cpu_count())
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.interpreter.resize_tensor_input(self.input_details["index"], [batch_size, *self.input_shape])
+        self.interpreter.allocate_tensors()
+
+        # 크기를 바꾼 뒤의 입출력 정보
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.output_channels = int(self.output_details["shape"][-1])
+
+        self.warmup()
+
+    def predict_batch(self, batch: np.ndarray):
+        input_dtype = self.input_details["dtype"]
+
+        if input_dtype != np.float32:
+            scale, zero_point = self.input_details["quantization"]
+            batch = np.clip(np.round(batch / scale + zero_point), np.iinfo(input_dtype).min, np.iinfo(input_dtype).max)
+
+        # 입력 설정부터 출력 복사까지 다른 스레드가 끼어들면 입력이나 출력 버퍼가 덮어쓰인다
+        with self.interpreter_lock:
+            self.interpreter.set_tensor(self.input_details["index"], batch.astype(input_dtype))
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self.output_details["index"])
+
+        if output.dtype != np.float32:
+            scale, zero_point = self.output_details["quantization"]
+            output = (output.astype("float32") - zero_point) * scale
+
+        return output.copy()
+
+def resolve_model(model_path=None, backend=None):
+    """get_session이 사용할 (모델 경로, 백엔드) - 모델을 불러오지 않고 분석 캐시 키를 만들 때도 쓴다"""
+
+    backend = backend or INFERENCE_BACKEND
+    if backend not in ("keras", "tflite"):
+        raise ValueError(f"unknown inference backend: {backend}")
+
+    if model_path is None:
+        model_path = TFLITE_MODEL_PATH if backend == "tflite" else MODEL_PATH
+
+    return model_path, backend
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(model_path=None, backend=None):
+    """
+    모델 경로와 백엔드("keras" 또는 "tflite")별로 하나의 세션을 만들어 재사용한다 (여러 스레드에서 불러도 한번만 만든다)
+
+    지정하지 않으면 settings의 INFERENCE_BACKEND와 그에 맞는 모델 경로를 사용한다
+    """
+
+    model_path, backend = resolve_model(model_path, backend)
+
+    with _sessions_lock:
+        if (model_path, backend) not in _sessions:
+            _sessions[(model_path, backend)] = TFLiteSession(model_path) if backend == "tflite" else InferenceSession(model_path)
+
+        return _sessions[(model_path, backend)]
@@ -15,10 +15,14 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from threading import Lock
+import time
 import cv2
 from enum import Enum
 import uuid
 
+# 입력을 기다리는 동안 마우스 입력을 확인하는 간격
+POLL_MS = 10
+
 class HairSEMEvents(Enum):
     PASS = 0
     EXIT = 1
@@ -27,51 +31,93 @@ class HairSEMEvents(Enum):
     SWITCH_MODE = 4
     SWITCH_IMAGE = 5
     ANALYZE = 6
+    ZOOM_IN = 7
+    ZOOM_OUT = 8
+    RESET_VIEW = 9
 
 class SubscriptionType(Enum):
-    LEFT_CLICK = 0
+    LEFT_CLICK = 0  # f(x, y)
+    RIGHT_DRAG = 1  # f(dx, dy) - 우클릭한 채로 움직인 거리
+    WHEEL = 2  # f(x, y, delta) - 위로 굴리면 delta > 0
 
 class InputManager:
     """입력 관리자"""
 
     def __init__(self):
+        self.active = False
         self.cursor_pos = None
-        self.lclick_watchers = {}
+        self.drag_origin = None
+        self.watchers = {subscription_type: {} for subscription_type in SubscriptionType}
         self.current_event = HairSEMEvents.PASS
 
     def on_mouse(self, event, x, y, flags, param):
         """cv2에게 전달할 마우스 입력 콜백"""
 
+        self.active = True
+
         # 커서의 위치
         if event == cv2.EVENT_MOUSEMOVE:
             self.cursor_pos = (x, y)
 
-        # 마우스 우클릭 처리
+        # 마우스 좌클릭 처리
         if event == cv2.EVENT_LBUTTONDOWN:
-            
-            watchers = list(self.lclick_watchers.values())  # Retrieve snapshot
+            self.notify(SubscriptionType.LEFT_CLICK, x, y)
+
+        # 우클릭한 채로 끌기 처리
+        elif event == cv2.EVENT_RBUTTONDOWN:
+            self.drag_origin = (x, y)
+        elif event == cv2.EVENT_RBUTTONUP:
+            self.drag_origin = None
+        elif event == cv2.EVENT_MOUSEMOVE and self.drag_origin is not None and flags & cv2.EVENT_FLAG_RBUTTON:
+            origin_x, origin_y = self.drag_origin
+            self.drag_origin = (x, y)
+            self.notify(SubscriptionType.RIGHT_DRAG, x - origin_x, y - origin_y)
+
+        # 마우스 휠 처리 (휠을 굴린 양은 flags의 상위 16비트에 부호와 함께 들어 있다)
+        elif event == cv2.EVENT_MOUSEWHEEL:
+            self.notify(SubscriptionType.WHEEL, x, y, flags >> 16)
+
+    def notify(self, subscription_type: SubscriptionType, *args):
+        """특정 이벤트의 리스너들을 호출한다"""
+
+        watchers = list(self.watchers[subscription_type].values())  # Retrieve snapshot
 
-            # 우클릭 리스너 처리
-            for watcher in watchers: 
-                watcher(x, y)
+        for watcher in watchers:
+            watcher(*args)
 
     def subscribe(self, subscription_type: SubscriptionType, f):
         """특정 이벤트의 리스너를 등록한다 그리고 등록된 UUID를 반환한다"""
 
-        if subscription_type == SubscriptionType.LEFT_CLICK:
-            uniqueId = uuid.uuid4()
-            self.lclick_watchers[uniqueId] = f
-            return uniqueId
+        uniqueId = uuid.uuid4()
+        self.watchers[subscription_type][uniqueId] = f
+        return uniqueId
     
     def unsubscribe(self, subscription_type: SubscriptionType, uniqueId):
         """특정 이벤트의 리스너를 등록 해제한다"""
 
-        if subscription_type == SubscriptionType.LEFT_CLICK:
-            self.lclick_watchers.pop(uniqueId, None)
+        self.watchers[subscription_type].pop(uniqueId, None)
+
+    def update(self, wait_ms=1, poll_ms=POLL_MS):
+        """
+        키보드 입력을 받아서 이벤트를 호출한다
+
+        키보드나 마우스 입력이 들어오거나 wait_ms가 지날 때까지 poll_ms 단위로 기다린다
+        (cv2.waitKey는 마우스 입력으로는 깨어나지 않으므로 잘게 나누어 기다린다)
+        """
+
+        self.active = False
+        deadline = time.perf_counter() + wait_ms / 1000
+
+        while True:
+            remaining_ms = (deadline - time.perf_counter()) * 1000
+            key = cv2.waitKey(max(1, int(min(poll_ms, remaining_ms))))
+
+            if key != -1 or self.active or remaining_ms <= poll_ms:
+                break
+
+        if key != -1:
+            self.active = True
 
-    def update(self):
-        """키보드 입력을 받아서 이벤트를 호출한다"""
-        key = cv2.waitKey(1)
         if key & 0xFF == ord('q'):
             self.current_event = HairSEMEvents.EXIT
         elif key & 0xFF == 27:
@@ -84,5 +130,11 @@ class InputManager:
             self.current_event = HairSEMEvents.SWITCH_IMAGE
         elif key & 0xFF == ord('a'):
             self.current_event = HairSEMEvents.ANALYZE
+        elif key & 0xFF in (ord('+'), ord('=')):
+            self.current_event = HairSEMEvents.ZOOM_IN
+        elif key & 0xFF == ord('-'):
+            self.current_event = HairSEMEvents.ZOOM_OUT
+        elif key & 0xFF == ord('0'):
+            self.current_event = HairSEMEvents.RESET_VIEW
         else:
             self.current_event = HairSEMEvents.PASS
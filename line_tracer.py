@@ -14,10 +14,14 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import ml_model
-from renderer import ImageRenderer, RenderTasks
+from analysis_worker import AnalysisJob
+from renderer import ImageRenderer, RenderLayer, RenderTasks
 from input_manager import HairSEMEvents, InputManager, SubscriptionType
 import geometrics
+import tracing
+
+# 분석 결과를 보여주는 상태 패널 항목
+ANALYSIS_RESULT_KEYS = ["S.SE", "n_chunks", "n_pixels", "std_dev", "best_angle"]
 
 class LineTracer:
     """
@@ -44,16 +48,18 @@ class LineTracer:
         """
 
         # 만약 첫번째 점은 결정되었지만 두번째 점은 결정되지 않았다면, 현재 마우스의 위치를 임시 위치로 설정한다
-        if not self.lock and self.start_point is not None:
-            self.end_point = self.input_manager.cursor_pos
+        if not self.lock and self.start_point is not None and self.input_manager.cursor_pos is not None:
+            self.end_point = self.renderer.to_image_coordinates(self.input_manager.cursor_pos)
 
         self.render_line()
     
     def on_click(self, x, y):
-        """화면 클릭 콜백"""
+        """화면 클릭 콜백 - 점은 이미지 좌표로 저장하므로 확대, 이동해도 정확하다"""
 
         if self.lock:
             return
+
+        x, y = self.renderer.to_image_coordinates((x, y))
         
         # 첫번째 점이 없다면 설정한다
         if self.start_point is None:  
@@ -78,26 +84,29 @@ class LineTracer:
         
         # 클릭된 두 점으로 이루어진 선분을 연장하여 화면의 가장자리와의 교점을 반환
         extended_ends = self.extend_line()
-        self.renderer.push_task(RenderTasks.DRAW_LINE, extended_ends)
+        # 고정된 선은 정적 레이어에, 커서를 따라 움직이는 선은 동적 레이어에 그린다
+        self.renderer.push_task(RenderTasks.DRAW_LINE, extended_ends, RenderLayer.STATIC if self.lock else RenderLayer.DYNAMIC)
 
     def extend_line(self):
         """클릭된 두 점으로 이루어진 선분을 연장하여 가장자리와의 교점을 반환한다"""
 
-        # 이 작업은 LienarGraph라는 클래스를 이용하여 처리한다
+        # 이 작업은 LienarGraph라는 클래스를 이용하여 처리한다 (이미지 좌표계에서 이미지 가장자리까지 연장)
         self.linear_graph = geometrics.LinearGraph(self.start_point, self.end_point)
 
-        return self.linear_graph.boundary_intercepts()
+        return self.linear_graph.boundary_intercepts(self.renderer.image_width, self.renderer.image_height)
     
 class LineTracerManager:
     """
     여러개의 LineTracer를 관리하기 위한 클래스
     """
 
-    def __init__(self, renderer: ImageRenderer, input_manager: InputManager):
+    def __init__(self, renderer: ImageRenderer, input_manager: InputManager, status_panel=None):
         self.renderer = renderer
         self.input_manager = input_manager
+        self.status_panel = status_panel if status_panel is not None else {}
         self.old_tracers = []
         self.current_tracer = LineTracer(renderer, input_manager)
+        self.analysis_job = None
 
     def initialize(self):
         """첫번째 LineTracer를 초기화 시킨다"""
@@ -120,14 +129,64 @@ class LineTracerManager:
             if len(self.old_tracers) == 0:
                 raise ValueError("No tracers registered")
             
-            # S.SE, 군집 수, 픽셀 수, 표준편차를 출력
+            # 이전 분석이 진행 중이라면 취소하고 새로 시작한다
+            self.cancel_analysis()
+
             print("running the program")
-            sum, n_chunks, n_pixels, std_dev = ml_model.analyze_original_image(self.old_tracers[-1].linear_graph.perpendicular_gradient(), self.renderer.raw_image.copy())
-            print(sum, n_chunks, n_pixels, std_dev)
+
+            # 분석은 백그라운드에서 진행되며, 추론 세션은 캐시에 결과가 없을 때만 불러와서 계속 재사용한다 (inference_session.get_session)
+            for key in ANALYSIS_RESULT_KEYS:
+                self.status_panel.pop(key, None)
+
+            # 추론은 한번만 하고 그려진 모든 선에 대해 S.SE를 원본 해상도 이미지에서 계산한다 (선은 이미지 좌표로 저장되어 있다)
+            gradients = [tracer.linear_graph.perpendicular_gradient() for tracer in self.old_tracers]
+            self.analysis_job = AnalysisJob(gradients, self.renderer.analysis_image())
+            self.analysis_job.start()
+
+    def cancel_analysis(self):
+        """진행 중인 분석을 취소한다"""
+
+        if self.analysis_job is not None and not self.analysis_job.finished:
+            self.analysis_job.cancel()
+            self.status_panel["analysis"] = self.analysis_job.status_text()
+
+        self.analysis_job = None
+
+    def update_analysis(self):
+        """백그라운드 분석의 진행 상황과 결과를 상태 패널에 반영한다"""
+
+        job = self.analysis_job
+        if job is None:
+            return
+
+        self.status_panel["analysis"] = job.status_text()
+
+        if not job.finished:
+            return
+
+        # 분석 완료 - 선별 S.SE, 군집 수, 픽셀 수, 표준편차, S.SE가 가장 작은 각도를 출력
+        if job.result is not None:
+            sums, n_chunks, n_pixels, std_dev, best_angle = job.result
+            print(sums, n_chunks, n_pixels, std_dev, best_angle)
+
+            self.status_panel["S.SE"] = ", ".join(f"{sum:.2f}" for sum in sums)
+            self.status_panel["n_chunks"] = n_chunks
+            self.status_panel["n_pixels"] = n_pixels
+            self.status_panel["std_dev"] = f"{std_dev:.2f}"
+            self.status_panel["best_angle"] = f"{best_angle:.1f}"
+        elif job.error is not None:
+            print(f"analysis failed: {job.error}")
+
+        # HAIRSEM_TRACE가 켜져 있다면 단계별 시간 요약을 보여준다
+        if tracing.enabled():
+            self.status_panel["trace"] = tracing.last_summary()
+
+        self.analysis_job = None
 
     def cleanup(self):
         """현재 클래스를 초기상태로 초기화"""
 
+        self.cancel_analysis()
         self.old_tracers = []
         self.current_tracer = LineTracer(self.renderer, self.input_manager)
 
@@ -135,6 +194,7 @@ class LineTracerManager:
         """업데이트(tick)"""
 
         self.handle_inputs()
+        self.update_analysis()
         
         # 모든 완료 트레이서 업데이트
         for tracer in self.old_tracers:
@@ -145,6 +205,9 @@ class LineTracerManager:
 
         # 현재 트레이서가 완료되면, 현재 트레이서를 완료 트레이서 리스트에 추가, 새로운 트레이서 생성
         if self.current_tracer.lock:
+            # 새로운 선이 그려졌으므로 진행 중인 분석은 취소한다
+            self.cancel_analysis()
+
             self.old_tracers.append(self.current_tracer)
             self.current_tracer = LineTracer(self.renderer, self.input_manager)
             self.current_tracer.initialize()
@@ -153,4 +216,5 @@ class LineTracerManager:
         """가장 최근에 완료된 트레이서 제거"""
         
         if len(self.old_tracers) > 0:
+            self.cancel_analysis()
             self.old_tracers.pop()
\ No newline at end of file
@@ -14,10 +14,12 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import cv2
 from application_manager import ApplicationManager
 from input_manager import InputManager, HairSEMEvents
 from renderer import ImageRenderer
+import image_source
 from settings import X_SIZE, Y_SIZE
 
 # 이미지 불러오기
@@ -25,14 +27,20 @@ from settings import X_SIZE, Y_SIZE
 path_raw_image = input("SEM 이미지 경로? ")  # "./sem_images/images/SEM_C_PRESSURE.jpg"
 path_mask_data = input("SEM 마스크 이미지 경로? ")  # "./sem_images/segmentation-masks/SEM_C_PRESSURE.jpg"
 
-raw_image_data = cv2.imread(path_raw_image)  # SEM 이미지 불러오기
+# 크기 정보가 없는 raw 이미지라면 크기와 자료형을 묻는다 (옆에 <파일 이름>.json이 있다면 그것을 읽는다)
+raw_shape, raw_dtype = None, "uint8"
+if path_raw_image.lower().endswith(image_source.RAW_EXTENSIONS) and not os.path.exists(image_source.raw_sidecar_path(path_raw_image)):
+    raw_shape = image_source.parse_shape(input("raw 이미지 크기 (높이,너비[,채널])? "))
+    raw_dtype = input("raw 이미지 자료형? (uint8) ") or "uint8"
+
+raw_image_source = image_source.open_image(path_raw_image, raw_shape, raw_dtype)  # SEM 이미지 열기 - 분석은 원본 해상도로 한다 (큰 TIFF, .npy, raw는 메모리 매핑)
 raw_mask_data = cv2.imread(path_mask_data)  # SEM 마스크 이미지 불러오기
 
-resized_image_data = cv2.resize(raw_image_data, (X_SIZE, Y_SIZE))
+resized_image_data = raw_image_source.thumbnail(X_SIZE, Y_SIZE)
 resized_mask_data = cv2.resize(raw_mask_data, (X_SIZE, Y_SIZE))
 
 input_manager = InputManager()  # 키보드, 마우스 입력을 위한 클래스 초기화
-renderer = ImageRenderer(resized_image_data, raw_mask_data, input_manager)  # 이미지 렌더링을 위한 클래스 초기화
+renderer = ImageRenderer(resized_image_data, resized_mask_data, input_manager, path_raw_image, raw_image_source)  # 이미지 렌더링을 위한 클래스 초기화
 
 # 애플리케이션 객체 초기화
 
@@ -50,4 +58,5 @@ while True:
     if input_manager.current_event == HairSEMEvents.EXIT:
         break
 
+application_manager.close()
 cv2.destroyAllWindows()
\ No newline at end of file
@@ -1,25 +1,38 @@
-from matplotlib import pyplot as plt
+import math
 import numpy as np
-import tensorflow as tf
 
 from settings import BOX_SIZE
-from scipy.ndimage import label
 
 MASK_THRESHOLD = 130
 
+def _box_min_pool(images: np.ndarray):
+    """(N, H, W, C) 이미지를 BOX_SIZE 상자로 나누어 상자별 (모든 채널의) 최솟값을 (N, H // BOX_SIZE, W // BOX_SIZE)로 반환"""
+
+    n, height, width, channels = images.shape
+    rows, cols = height // BOX_SIZE, width // BOX_SIZE
+
+    boxes = images[:, :rows * BOX_SIZE, :cols * BOX_SIZE].reshape(n, rows, BOX_SIZE, cols, BOX_SIZE, channels)
+    return boxes.min(axis=(2, 4, 5))
+
+def _binarize_boxes(box_mins: np.ndarray, first_row=True):
+    """상자별 최솟값을 MASK_THRESHOLD 기준으로 0 또는 255로 이진화하고, 가장자리 상자는 0으로 만든다 (first_row가 False라면 첫 행은 그대로 둔다)"""
+
+    binarized = np.where(box_mins < MASK_THRESHOLD, 0, 255).astype("uint8")
+    if first_row:
+        binarized[:, 0, :] = 0
+    binarized[:, :, 0] = 0
+
+    return binarized
+
 def flatten_predicted_mask(image: np.ndarray):
     """2x2 박스로 전체 이미지를 나누어 flattening 작업을 수행한다"""
 
-    x_size, y_size, _ = image.shape
+    rows, cols = image.shape[0] // BOX_SIZE, image.shape[1] // BOX_SIZE
 
-    for x in range(0, x_size - BOX_SIZE + 1, BOX_SIZE):
-        for y in range(0, y_size - BOX_SIZE + 1, BOX_SIZE):
-            # 각 상자의 최솟값으로 픽셀을 치환
-            min = image[x: x+BOX_SIZE, y: y+BOX_SIZE, :].min()
-            min = 0 if min < MASK_THRESHOLD else 255
-            if x == 0 or y == 0:
-                min = 0
-            image[x: x+BOX_SIZE, y: y+BOX_SIZE] = np.array([[[min, min, min]] * BOX_SIZE] * BOX_SIZE)
+    # 각 상자의 최솟값으로 픽셀을 치환
+    binarized = _binarize_boxes(_box_min_pool(image[np.newaxis]))[0]
+    expanded = np.repeat(np.repeat(binarized, BOX_SIZE, axis=0), BOX_SIZE, axis=1)
+    image[:rows * BOX_SIZE, :cols * BOX_SIZE] = expanded[:, :, np.newaxis]
 
     return image
 
@@ -30,67 +43,214 @@ def coerce_image(image: np.ndarray):
 
    coerced_image = (image - min) * 255 / (max - min)
 
-   return np.vectorize(lambda x: int(x))(coerced_image)
+   return coerced_image.astype("uint8")
+
+def normalize_predictions(predicts: np.ndarray):
+    """(N, H, W, C) 예측 텐서를 이미지별 최솟값, 최댓값 기준으로 0~255 float32로 정규화 (값이 모두 같은 이미지는 0으로 처리)"""
+
+    predicts = np.asarray(predicts, dtype="float32")
+
+    lows = predicts.min(axis=(1, 2, 3), keepdims=True)
+    ranges = predicts.max(axis=(1, 2, 3), keepdims=True) - lows
+
+    return np.divide((predicts - lows) * 255, ranges, out=np.zeros_like(predicts), where=ranges > 0)
+
+def binarize_predictions(coerced: np.ndarray):
+    """
+    0~255로 정규화된 (N, H, W, C) 예측을 BOX_SIZE 상자 최솟값 풀링, MASK_THRESHOLD 이진화, 가장자리 제거하여
+    (N, H, W) uint8 마스크(0 또는 255)로 반환한다. 상자에 들어가지 않는 나머지 픽셀은 0이다.
+    """
+
+    n, height, width, _ = coerced.shape
+    binarized = _binarize_boxes(_box_min_pool(coerced))
+
+    masks = np.zeros((n, height, width), dtype="uint8")
+    rows, cols = binarized.shape[1] * BOX_SIZE, binarized.shape[2] * BOX_SIZE
+    masks[:, :rows, :cols] = np.repeat(np.repeat(binarized, BOX_SIZE, axis=1), BOX_SIZE, axis=2)
+
+    return masks
+
+def binarize_rows(coerced: np.ndarray, start_row, out: np.ndarray = None):
+    """
+    이미지의 start_row행부터 시작하는 띠 하나(0~255로 정규화된 (h, W, C) 예측)를 이진화하여 out의 같은 행에 쓴다
+
+    띠마다 호출하면 binarize_predictions를 이미지 전체에 한번 적용한 것과 같은 결과가 된다.
+    start_row는 BOX_SIZE의 배수여야 하며, 마지막 띠가 아니라면 띠의 높이도 BOX_SIZE의 배수여야 한다.
+    out이 주어지지 않으면 띠의 (h, W) uint8 마스크를 반환한다.
+    """
+
+    height, width, _ = coerced.shape
+    binarized = _binarize_boxes(_box_min_pool(coerced[np.newaxis]), first_row=start_row == 0)[0]
+
+    band = np.zeros((height, width), dtype="uint8")
+    rows, cols = binarized.shape[0] * BOX_SIZE, binarized.shape[1] * BOX_SIZE
+    band[:rows, :cols] = np.repeat(np.repeat(binarized, BOX_SIZE, axis=0), BOX_SIZE, axis=1)
+
+    if out is None:
+        return band
+
+    out[start_row:start_row + height] = band
+    return out
+
+def postprocess_predictions(predicts: np.ndarray):
+    """
+    (N, H, W, C) 예측 텐서 전체를 한번에 후처리하여 (N, H, W) uint8 마스크(0 또는 255)로 반환
+
+    coerce_image, flatten_predicted_mask와 같은 결과를 배치 전체에 대해 몇 번의 배열 연산으로 수행한다
+    """
+
+    return binarize_predictions(normalize_predictions(predicts))
+
+class Components:
+    """
+    마스크에서 레이블링된 군집들을 압축된 형태로 담는 클래스
+
+    labels: 군집 번호가 매겨진 2차원 레이블 이미지 (0은 배경, i번째 군집은 i + 1)
+    offsets, coords: CSR 형태로 저장된 군집별 픽셀 좌표 - i번째 군집의 (x, y) 좌표는 coords[offsets[i]:offsets[i + 1]]
+    area, sum_x, sum_y: 군집별 픽셀 수와 좌표의 합
+    m_xx, m_yy, m_xy: 군집별 평균을 중심으로 한 2차 모멘트
+    """
+
+    def __init__(self, labels, offsets, coords, area, sum_x, sum_y, m_xx, m_yy, m_xy):
+        self.labels = labels
+        self.offsets = offsets
+        self.coords = coords
+        self.area = area
+        self.sum_x = sum_x
+        self.sum_y = sum_y
+        self.m_xx = m_xx
+        self.m_yy = m_yy
+        self.m_xy = m_xy
+
+    @classmethod
+    def from_moments(cls, area, sum_x, sum_y, m_xx, m_yy, m_xy):
+        """레이블 이미지와 픽셀 좌표 없이 회귀에 필요한 군집별 값만 담은 Components를 만든다 (analysis_pipeline의 결과 등)"""
+
+        return cls(None, np.zeros(len(area) + 1, dtype="int64"), np.zeros((0, 2), dtype="int64"), area, sum_x, sum_y, m_xx, m_yy, m_xy)
+
+    def __len__(self):
+        return len(self.area)
+
+    def pixels(self, index):
+        """index번째 군집의 (x, y) 좌표 배열을 반환"""
+
+        return self.coords[self.offsets[index]:self.offsets[index + 1]]
+
+    def regression_losses(self, gradient):
+        """기울기가 고정된 선형회귀의 군집별 최소 제곱오차합을 반환"""
+
+        return component_regression_losses(gradient, self.m_xx, self.m_yy, self.m_xy)
+
+    def total_regression_losses(self, gradients):
+        """
+        여러 기울기에 대한 S.SE(모든 군집의 최소 제곱오차합)를 한번에 반환
+
+        S.SE(g) = Σm_yy - 2g·Σm_xy + g²·Σm_xx 이므로 모멘트의 합 세 개만으로 기울기 개수만큼의 S.SE를 구할 수 있다
+        """
+
+        gradients = np.asarray(gradients, dtype="float64")
+        total_m_xx, total_m_yy, total_m_xy = self.m_xx.sum(), self.m_yy.sum(), self.m_xy.sum()
+
+        return np.maximum(total_m_yy - 2 * gradients * total_m_xy + gradients * gradients * total_m_xx, 0.0)
+
+    def best_gradient(self):
+        """S.SE를 가장 작게 만드는 기울기 Σm_xy / Σm_xx (군집이 모두 세로선이라면 inf)"""
+
+        total_m_xx = self.m_xx.sum()
+
+        return float(self.m_xy.sum() / total_m_xx) if total_m_xx > 0 else math.inf
+
+def moments_to_central(area, sum_x, sum_y, sum_xx, sum_yy, sum_xy):
+    """군집별 좌표의 합과 제곱합으로부터 평균을 중심으로 한 2차 모멘트 (m_xx, m_yy, m_xy)를 구한다"""
+
+    area = np.maximum(area, 1)
+
+    return sum_xx - sum_x * sum_x / area, sum_yy - sum_y * sum_y / area, sum_xy - sum_x * sum_y / area
+
+def label_components(mask: np.ndarray):
+    """2차원 마스크를 4-연결 기준으로 레이블링하여 Components로 반환"""
+
+    from scipy.ndimage import label
+
+    # 모든 채널이 같은 값을 가지므로 첫번째 채널만 사용한다
+    if mask.ndim == 3:
+        mask = mask[:, :, 0]
+
+    labels, ncc = label(mask != 0)
+    width = labels.shape[1]
+
+    # 배경이 아닌 픽셀을 군집 번호 순서대로 정렬 (군집 내부는 행 우선 순서 유지)
+    flat_labels = labels.ravel()
+    foreground = np.flatnonzero(flat_labels)
+    order = foreground[np.argsort(flat_labels[foreground], kind="stable")]
+    ids = flat_labels[order] - 1
+
+    ys, xs = np.divmod(order, width)
+    coords = np.stack([xs, ys], axis=1).astype("int32")
+
+    area = np.bincount(ids, minlength=ncc)
+    offsets = np.zeros(ncc + 1, dtype="intp")
+    np.cumsum(area, out=offsets[1:])
+
+    # 군집별 좌표의 합과 평균
+    sum_x = np.bincount(ids, weights=xs, minlength=ncc)
+    sum_y = np.bincount(ids, weights=ys, minlength=ncc)
+    dx = xs - (sum_x / np.maximum(area, 1))[ids]
+    dy = ys - (sum_y / np.maximum(area, 1))[ids]
+
+    # 군집별 중심 2차 모멘트
+    m_xx = np.bincount(ids, weights=dx * dx, minlength=ncc)
+    m_yy = np.bincount(ids, weights=dy * dy, minlength=ncc)
+    m_xy = np.bincount(ids, weights=dx * dy, minlength=ncc)
+
+    return Components(labels, offsets, coords, area, sum_x, sum_y, m_xx, m_yy, m_xy)
 
 def chunkify(image: np.ndarray):
-    """마스크에서 군집을 추출해낸다"""
-
-    x_size, y_size, _ = image.shape
-
-    # 군집 레이블링
-    
-    marker, ncc = label(image)
-    marked_pixels = [[] for i in range(ncc + 1)]
-
-    for y in range(y_size):
-        for x in range(x_size):
-            # 검은색 픽셀이라면 군집에 포함시키지 않는다
-            if image[y, x, 0] == 0:
-                continue
-            
-            r, g, b = marker[y, x]
-            if r != g or g != b:
-                raise ValueError("invalid marker")
-            
-            # 군집 별로 픽셀의 좌표를 대입한다
-            marked_pixels[r].append((x, y))
-
-    return list(filter(lambda x: len(x) != 0, marked_pixels))
-
-@tf.function
-def cost_function(gradient, X, Y, bias, N):
-    """선형회귀 - MSE 손실함수 정의"""
-
-    pred = tf.add(tf.multiply(X, gradient), bias)
-    offset = tf.subtract(pred, Y)
-    loss = tf.reduce_sum(tf.multiply(offset, offset))
-    
-    return tf.divide(loss, N)
+    """마스크에서 군집을 추출해낸다 - 군집별 (x, y) 좌표 리스트"""
 
-def mask_linear_regression(gradient, pixels):
-    """마스크의 군집에 대해 선형회귀 진행 및 최소 MSE 반환"""
+    components = label_components(image)
+
+    return [list(map(tuple, components.pixels(i).tolist())) for i in range(len(components))]
 
-    # 텐서 정의
+def segment_regression_losses(gradient, x: np.ndarray, y: np.ndarray, segment_ids: np.ndarray, n_segments: int):
+    """
+    기울기가 고정된 선형회귀를 모든 군집에 대해 한번에 수행하고 군집별 최소 제곱오차합을 반환
 
-    bias = tf.Variable(0.0, name = "b")
-    gradient_tensor = tf.constant(gradient)
-    N = tf.constant(float(len(pixels)))
-    x = tf.constant(list(map(lambda x: float(x[0]), pixels)))
-    y = tf.constant(list(map(lambda x: float(x[1]), pixels)))
+    기울기가 고정되어 있으면 최적의 절편은 y - g * x 의 평균이므로 경사하강 없이 바로 구할 수 있다
+    """
 
-    # 학습 - 경사하강
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    segment_ids = np.asarray(segment_ids, dtype="intp")
 
-    @tf.function
-    def train(learning_rate=0.03):
-        with tf.GradientTape() as t:
-                current_loss = cost_function(gradient_tensor, x, y, bias, N)
-                dBias = t.gradient(current_loss, [bias])[0]
+    # 잔차 y - g * x
+    residuals = y - gradient * x
+
+    # 군집별 최적 절편 = 잔차의 평균
+    counts = np.bincount(segment_ids, minlength=n_segments)
+    sums = np.bincount(segment_ids, weights=residuals, minlength=n_segments)
+    biases = sums / np.maximum(counts, 1)
+
+    # 절편을 뺀 잔차의 제곱합
+    offsets = residuals - biases[segment_ids]
+    return np.bincount(segment_ids, weights=offsets * offsets, minlength=n_segments)
+
+def component_regression_losses(gradient, m_xx: np.ndarray, m_yy: np.ndarray, m_xy: np.ndarray):
+    """
+    군집별 중심 2차 모멘트로부터 기울기가 고정된 선형회귀의 최소 제곱오차합을 반환
+
+    절편이 평균으로 정해지므로 제곱오차합은 Σ((y - ȳ) - g(x - x̄))² = m_yy - 2g·m_xy + g²·m_xx 이다
+    """
+
+    return np.maximum(m_yy - 2 * gradient * m_xy + gradient * gradient * m_xx, 0.0)
+
+def mask_linear_regression(gradient, pixels):
+    """마스크의 군집에 대해 선형회귀 진행 및 최소 제곱오차합 반환"""
 
-        bias.assign_sub(learning_rate * dBias)
+    if len(pixels) == 0:
+        return 0.0
 
-    for i in range(100):
-        train()
+    coords = np.asarray(pixels, dtype="float64")
+    segment_ids = np.zeros(len(coords), dtype="intp")
 
-    loss = cost_function(gradient, x, y, bias, len(pixels))
-    
-    return float(loss.numpy() * N.numpy())
\ No newline at end of file
+    return float(segment_regression_losses(gradient, coords[:, 0], coords[:, 1], segment_ids, 1)[0])
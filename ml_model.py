@@ -17,48 +17,30 @@
 #   Portions of this code are licensed under the Apache License, Version 2.0. 
 #   See the LICENSE-APACHE file for details.
 
-import math
-import random
-import uuid
-from matplotlib import pyplot as plt
+import tempfile
 import numpy as np
-import tensorflow as tf
-from IPython.display import clear_output
-from tensorflow_examples.tensorflow_examples.models.pix2pix import pix2pix
-from dataset_manager import load_dataset
+import analysis_cache
+import analysis_pipeline
+from chunk_statistics import ChunkStatistics
+import geometrics
+import image_source
 import mask_analysis
+import inference_session
+import tiling
+import tracing
+from tiling import random_shuffle_mask
+from settings import ANALYSIS_PIPELINE, BOX_SIZE, CROP_IMAGE_SIZE, STITCH_MEMMAP_PIXELS, TILE_STRIDE
 
-test_images, train_images, test_masks, train_masks = load_dataset()
-
-sample_image, sample_mask = train_images[2], train_masks[2]
+# 이어붙인 예측을 한번에 이진화하는 행 수 (BOX_SIZE의 배수)
+BINARIZE_BAND_ROWS = BOX_SIZE * 256
 
 # Source code from Tensorflow docs - start
 
-class DisplayCallback(tf.keras.callbacks.Callback):
-    def on_epoch_end(self, epoch, logs=None):
-        clear_output(wait=True)
-        
-        global model
-
-        title = ['Input Image', 'True Mask', 'Predicted Mask']
-        display_list = [sample_image, sample_mask * 255, mask_analysis.coerce_image(np.array(model.predict(np.array([sample_image]))[0]))]
-
-        if True or epoch % 20 == 0:
-            plt.figure(figsize=(15, 15))
-            for i in range(3):
-                plt.subplot(1, 3, i+1)
-                plt.title(title[i])
-                plt.imshow(display_list[i])
-                plt.colorbar()
-                plt.axis('off')
-            plt.show()
+def unet_model(output_channels = 3, weights = "imagenet"):
+    import tensorflow as tf
+    from tensorflow_examples.tensorflow_examples.models.pix2pix import pix2pix
 
-        model.save(f'models/epoch{epoch}-{uuid.uuid4()}.keras')
-
-        print(f'\nSample Prediction after epoch {epoch + 1}\n')
-
-def unet_model(output_channels = 3):
-    base_model = tf.keras.applications.MobileNetV2(input_shape=[128, 128, 3], include_top=False)
+    base_model = tf.keras.applications.MobileNetV2(input_shape=[128, 128, 3], include_top=False, weights=weights)
 
     # Use the activations of these layers
     layer_names = [
@@ -107,85 +89,220 @@ def unet_model(output_channels = 3):
 
 # end
 
-def train_model():
-    """모델을 학습시켜서 반환"""
+def get_predicted_mask(images, session=None, backend=None):
+    """사전 학습된 모델을 이용해 예측 마스크 반환 - backend로 "keras" 또는 "tflite"를 고를 수 있다"""
+
+    # 사전 학습된 모델 - 한번 불러온 세션을 재사용한다
+    if session is None:
+        session = inference_session.get_session(backend=backend)
+
+    with tracing.span("inference", tiles=len(images)):
+        predicts = session.predict(images)
+
+    # 모든 예측을 한번에 정규화, 풀링, 이진화하여 (N, 128, 128) uint8 마스크로 변환
+    with tracing.span("postprocess", nbytes=predicts.nbytes):
+        return mask_analysis.postprocess_predictions(predicts)
+
+def predict_full_mask(image, session=None, stride=TILE_STRIDE, progress=None):
+    """
+    겹치는 128x128 타일로 이미지 전체를 추론하고, 예측을 이어붙여 (H, W) uint8 예측 마스크를 반환
+
+    image는 배열 또는 image_source.ImageSource이며, 타일은 추론할 배치만큼만 읽으므로 메모리 매핑된 원본 해상도 이미지도
+    전부 메모리에 올리지 않는다. 타일별로 0~255 정규화한 예측을 겹치는 영역에서 섞은 뒤, 이어붙인 이미지를 띠 단위로
+    풀링, 이진화한다. 픽셀 수가 STITCH_MEMMAP_PIXELS보다 많다면 이어붙이는 누적 배열을 임시 파일에 메모리 매핑한다.
+    progress가 주어지면 progress(단계, 완료 수, 전체 수)로 진행 상황을 알린다.
+    """
+
+    if session is None:
+        session = inference_session.get_session()
+
+    source = image_source.as_image_source(image)
+    y_size, x_size = source.height, source.width
+
+    # 이미지 전체를 덮는 겹치는 타일의 위치 (타일보다 작은 이미지는 가장자리로 채운다)
+    positions = tiling.tile_positions(max(y_size, CROP_IMAGE_SIZE), max(x_size, CROP_IMAGE_SIZE), CROP_IMAGE_SIZE, stride)
+    directory = tempfile.gettempdir() if y_size * x_size > STITCH_MEMMAP_PIXELS else None
+    stitcher = tiling.TileStitcher(y_size, x_size, session.output_channels, CROP_IMAGE_SIZE, directory)
+
+    for start in range(0, len(positions), session.batch_size):
+        batch_positions = positions[start:start + session.batch_size]
+
+        # 이번 배치의 타일만 읽는다 (타일은 복사본이므로 원본은 바뀌지 않는다)
+        with tracing.span("tiling") as span:
+            tiles = tiling.read_tiles(source, batch_positions, CROP_IMAGE_SIZE)
+            for tile in tiles:
+                random_shuffle_mask(tile)
+
+            span.set(tiles=len(tiles), nbytes=tiles.nbytes)
+
+        with tracing.span("inference", tiles=len(tiles)):
+            predicts = session.predict(tiles)
+
+        # 타일별 예측을 전체 이미지에 누적
+        with tracing.span("stitching", nbytes=predicts.nbytes):
+            stitcher.add(mask_analysis.normalize_predictions(predicts), batch_positions)
+
+        if progress is not None:
+            progress("tiles", start + len(tiles), len(positions))
+
+    # 이어붙인 예측을 띠 단위로 이진화
+    with tracing.span("postprocess", height=y_size, width=x_size):
+        predicted_mask = np.zeros((y_size, x_size), dtype="uint8")
+
+        for row in range(0, y_size, BINARIZE_BAND_ROWS):
+            mask_analysis.binarize_rows(stitcher.rows(row, min(row + BINARIZE_BAND_ROWS, y_size)), row, predicted_mask)
+
+        return predicted_mask
+
+def extract_components(image: np.ndarray, session=None, stride=TILE_STRIDE, progress=None, cache=None, model_path=None, backend=None):
+    """
+    원본 이미지를 추론하고 예측 마스크의 군집을 추출하여 Components로 반환 - 기울기와 상관없는 단계
+
+    같은 이미지, 모델, 타일링 설정의 결과는 디스크 캐시에서 가져온다 (cache, model_path, backend는 analyze_original_image와 같다).
+    ANALYSIS_PIPELINE이 켜져 있다면 전체 예측 마스크를 만들지 않고 analysis_pipeline으로 추론한다. 캐시에는 군집별 모멘트만
+    저장하므로, 캐시나 파이프라인의 결과는 레이블 이미지와 픽셀 좌표가 없는 Components (Components.from_moments)이다.
+    """
+
+    cache = _resolve_cache(cache)
+    key = _prediction_key(image, session, stride, cache, model_path, backend)
+
+    return _extract_components(image, session, stride, progress, cache, key, model_path, backend)
+
+def evaluate_components(target_gradient, components: mask_analysis.Components):
+    """추출한 군집으로 (S.SE, 군집 수, 픽셀 수, 군집 크기의 표준편차)를 계산한다 - 기울기에 따라 달라지는 단계 (군집이 없다면 모두 0)"""
+
+    with tracing.span("regression", chunks=len(components)):
+        statistics = ChunkStatistics.from_components(components, target_gradient)
+
+    return statistics.result()
+
+def analyze_original_image(target_gradient, image: np.ndarray, session=None, stride=TILE_STRIDE, progress=None, cache=None, model_path=None, backend=None):
+    """
+    원본 이미지로부터 분석 - progress가 주어지면 progress(단계, 완료 수, 전체 수)로 진행 상황을 알린다
+
+    같은 이미지, 모델, 타일링 설정의 예측 마스크와 군집 표, 같은 기울기의 분석 결과는 디스크 캐시에서 가져온다.
+    cache가 주어지지 않으면 analysis_cache.get_cache()를 사용하며, False라면 캐시를 쓰지 않는다.
+    session이 주어지지 않으면 model_path, backend의 세션을 캐시에 없을 때만 불러온다 (inference_session.get_session).
+
+    ANALYSIS_PIPELINE이 켜져 있다면 군집이 캐시에 없을 때 analysis_pipeline으로 단계를 겹쳐서 분석한다.
+    이때는 전체 예측 마스크를 만들지 않으므로 군집별 모멘트만 캐시에 저장하며, 다른 기울기로 다시 분석할 때 이를 사용한다.
+    """
+
+    with tracing.span("analyze", height=image.shape[0], width=image.shape[1]) as span:
+        cache = _resolve_cache(cache)
+        key = _prediction_key(image, session, stride, cache, model_path, backend)
+
+        # 같은 기울기로 분석한 적이 있다면 결과를 바로 반환
+        if key is not None:
+            result = cache.get_result(key, target_gradient)
+            if result is not None:
+                span.set(cached="result")
+                return result
+
+        result = evaluate_components(target_gradient, _extract_components(image, session, stride, progress, cache, key, model_path, backend))
+
+        if key is not None:
+            cache.put_result(key, target_gradient, result)
+
+        return result
+
+def sweep_gradients(gradients, components: mask_analysis.Components):
+    """여러 기울기에 대한 S.SE를 추론을 다시 하지 않고 한번에 계산하여 (len(gradients),) 배열로 반환"""
+
+    return components.total_regression_losses(gradients)
+
+def sweep_angles(components: mask_analysis.Components, angles=None):
+    """
+    큐티클 선의 각도(화면 기준 수평선에서 반시계 방향, 도)에 따른 S.SE 곡선을 계산한다
+
+    angles가 주어지지 않으면 0도부터 180도까지 1도 간격으로 계산하며, (각도 배열, S.SE 배열, 가장 잘 맞는 각도)를 반환한다
+    """
+
+    angles = np.arange(0.0, 180.0, 1.0) if angles is None else np.asarray(angles, dtype="float64")
+    losses = sweep_gradients(geometrics.perpendicular_gradients_from_angles(angles), components)
+
+    return angles, losses, best_fitting_angle(components)
+
+def best_fitting_angle(components: mask_analysis.Components):
+    """S.SE가 가장 작은 큐티클 선의 각도 - 최적 기울기가 닫힌 형태로 구해지므로 각도를 훑지 않아도 된다"""
+
+    return geometrics.angle_from_perpendicular_gradient(components.best_gradient())
+
+def _resolve_session(session, model_path=None, backend=None):
+    return session if session is not None else inference_session.get_session(model_path, backend)
+
+def _resolve_cache(cache):
+    return cache if cache is not None else analysis_cache.get_cache()
+
+def _prediction_key(image, session, stride, cache, model_path=None, backend=None):
+    """
+    캐시를 쓸 수 있다면 예측 캐시 키를, 아니라면 None을 반환
 
-    model = unet_model()
-    model.compile(optimizer='adam',
-                loss=tf.keras.losses.CategoricalCrossentropy(from_logits=True),
-                metrics=['accuracy'])
+    session이 없다면 불러올 세션의 모델 경로와 백엔드로 키를 만든다 - 캐시에 있다면 모델을 불러오지 않아도 된다
+    """
 
-    model.fit(train_images, train_masks, epochs=200, batch_size=64, validation_data=(test_images, test_masks), callbacks=[DisplayCallback()])
-    return model
+    if not cache:
+        return None
 
-def get_predicted_mask(images):
-    """사전 학습된 모델을 이용해 예측 마스크 반환"""
+    if session is None:
+        model_path, backend = inference_session.resolve_model(model_path, backend)
+    else:
+        model_path, backend = session.model_path, getattr(session, "backend", type(session).__name__)
 
-    # 사전 학습된 모델
-    model = tf.keras.models.load_model("sem_analysis.keras")
+    return analysis_cache.prediction_key(image, model_path, stride, backend)
 
-    predicts = np.array(model.predict(np.array(images)))
-    new_images = [mask_analysis.coerce_image(predicts[i]) for i in range(len(predicts))]
-    new_images = [mask_analysis.flatten_predicted_mask(new_image) for new_image in new_images]
+def _cached_moments(cache, key):
+    """캐시된 군집별 모멘트 - 없다면 None"""
 
-    return new_images
+    with tracing.span("cache lookup") as span:
+        components = cache.get_moments(key) if key is not None else None
+        span.set(hit=components is not None)
 
-def random_shuffle_mask(raw_image):
-    """무작위로 3x3 구멍을 만든다"""
+    return components
 
-    for i in range(10):
-        random_x = random.randint(1, 126)
-        random_y = random.randint(1, 126)
+def _extract_components(image, session, stride, progress, cache, key, model_path=None, backend=None):
+    components = _cached_moments(cache, key)
 
-        for x_offset in range(3):
-            for y_offset in range(3):
-                raw_image[random_y + y_offset - 1, random_x + x_offset - 1] = 0
-    
-    return raw_image
+    if components is None:
+        # 추론은 캐시에 없을 때만 한다 (모델도 이때만 불러온다)
+        session = _resolve_session(session, model_path, backend)
 
-def analyze_original_image(target_gradient, image: np.ndarray):
-    """원본 이미지로부터 분석"""
+        if ANALYSIS_PIPELINE:
+            # 단계를 겹쳐서 추론하고 군집별 모멘트만 모은다 (기울기는 쓰지 않는다)
+            _, components = analysis_pipeline.analyze_pipelined(0.0, image, session, stride, progress)
+        else:
+            # 이어붙인 전체 예측 마스크에서 한번에 군집 추출
+            predicted_mask = predict_full_mask(image, session, stride, progress)
 
-    total_loss = 0
-    n_chunks = 0
-    n_pixels = 0
-    pixels = []
-    y_size, x_size, _ = image.shape
+            with tracing.span("labelling") as span:
+                components = mask_analysis.label_components(predicted_mask)
+                span.set(chunks=len(components), nbytes=components.labels.nbytes + components.coords.nbytes)
 
-    # 이미지를 128x128로 분할
-    images = []
-    for x in range(0, x_size, 128):
-        for y in range(0, y_size, 128):
-            if x + 128 > x_size or y + 128 > y_size:
-                continue
-        
-            cropped_image = image[y:y+128, x:x+128]
-            cropped_image = random_shuffle_mask(cropped_image)
+        # 어떤 기울기의 S.SE든 모멘트만으로 계산할 수 있으므로 마스크와 레이블 이미지는 저장하지 않는다
+        if key is not None:
+            with tracing.span("cache store", chunks=len(components)):
+                cache.put_moments(key, components)
 
-            images.append(cropped_image)
+    if progress is not None:
+        progress("chunks", len(components), len(components))
 
-    # 각 분할된 이미지 별로 예측 마스크 추출
-    images = get_predicted_mask(images)
+    return components
 
-    for predicted_mask in images:
-        # 128x128 이미지 별로 군집 추출
-        chunks = mask_analysis.chunkify(predicted_mask)
+    components = _cached_components(cache, key)
 
-        # 분석
-        n_chunks += len(chunks)
-        for chunk in chunks:
-            n_pixels += len(chunk)
-            pixels.append(len(chunk))
-            total_loss += mask_analysis.mask_linear_regression(target_gradient, chunk)
+    if components is None:
+        # 이어붙인 전체 예측 마스크에서 한번에 군집 추출 (모델은 이때만 불러온다)
+        predicted_mask = predict_full_mask(image, _resolve_session(session, model_path, backend), stride, progress)
 
-        print("successfully processed an image")
+        with tracing.span("labelling") as span:
+            components = mask_analysis.label_components(predicted_mask)
+            span.set(chunks=len(components), nbytes=components.labels.nbytes + components.coords.nbytes)
 
-    # 군집의 평균 픽셀 수 구하기
-    pixels_per_chunk = n_pixels / n_chunks
+        if key is not None:
+            with tracing.span("cache store"):
+                cache.put_components(key, predicted_mask, components)
 
-    # 표준편차를 구하기 위한 코드
-    sum = 0
-    for i in pixels:
-        sum += (i - pixels_per_chunk) ** 2
+    if progress is not None:
+        progress("chunks", len(components), len(components))
 
-    return total_loss, n_chunks, n_pixels, math.sqrt(sum / n_chunks)
\ No newline at end of file
+    return components
@@ -16,10 +16,12 @@
 
 from enum import Enum
 import cv2
-from matplotlib import pyplot as plt
 import numpy as np
 
-from input_manager import HairSEMEvents, InputManager
+from image_pyramid import ImagePyramid, TileCache
+from image_source import ImageSource
+from input_manager import HairSEMEvents, InputManager, SubscriptionType
+from settings import MAX_ZOOM, ZOOM_STEP
 
 class RenderTasks(Enum):
     DRAW_LINE = 0
@@ -29,39 +31,71 @@ class ImageType(Enum):
     RAW_IMAGE = 0
     RAW_MASK_IMAGE = 1
 
+class RenderLayer(Enum):
+    STATIC = 0  # 잘 바뀌지 않는 오버레이 (고정된 선, 상태 텍스트) - 바뀔 때만 다시 그린다
+    DYNAMIC = 1  # 커서를 따라 바뀌는 오버레이
+
 class ImageRenderer:
     """
     이미지 렌더링을 위한 관리자
+
+    원본 이미지 위에 정적 레이어를 한번 그려서 캐시해 두고, 매 tick마다 등록된 태스크가 이전 tick과 같다면
+    아무것도 다시 그리지 않는다. 동적 레이어가 있을 때만 정적 레이어를 복사하여 그 위에 그린다.
+
+    화면은 raw_image 크기의 창이며, 원본 해상도 이미지의 일부를 확대/축소하여 보여준다. 배경은 이미지 피라미드에서
+    화면에 보이는 타일만 합성하고, 타일은 LRU 타일 캐시에 보관한다. 선분의 좌표는 이미지 좌표(원본 픽셀)로 받는다.
     """
 
-    def __init__(self, raw_image: np.ndarray, raw_mask_image: np.ndarray, input_manager: InputManager):
+    def __init__(self, raw_image: np.ndarray, raw_mask_image: np.ndarray, input_manager: InputManager, source_path=None, source=None):
+        self.source_path = source_path
         self.raw_image = np.copy(raw_image)
         self.raw_mask_image = np.copy(raw_mask_image)
         self.image_type = ImageType.RAW_IMAGE
 
-        self.image = np.copy(raw_image)
-        self.tasks = []
+        # 분석에 쓰는 원본 해상도 이미지 (image_source.ImageSource) - 없다면 화면 크기의 이미지를 원본으로 쓴다
+        self.source = source if source is not None else ImageSource(self.raw_image)
+        self.image_width, self.image_height = self.source.width, self.source.height
+
+        self.tile_cache = TileCache()
+        self.pyramids = {
+            ImageType.RAW_IMAGE: ImagePyramid(self.source, self.tile_cache),
+            ImageType.RAW_MASK_IMAGE: ImagePyramid(self.raw_mask_image, self.tile_cache),
+        }
+
+        self.view_height, self.view_width = self.raw_image.shape[:2]
+        self.reset_view()
+        self.showing_preview = False
+
+        self.image = self.raw_image
+        self.static_layer = None
+        self.tasks = {RenderLayer.STATIC: [], RenderLayer.DYNAMIC: []}
+        self.rendered_tasks = {RenderLayer.STATIC: None, RenderLayer.DYNAMIC: None}
+        self.dirty = True
         self.input_manager = input_manager
 
-    def push_task(self, task_type, payload):
+        if input_manager is not None:
+            input_manager.subscribe(SubscriptionType.WHEEL, self.on_wheel)
+            input_manager.subscribe(SubscriptionType.RIGHT_DRAG, self.on_drag)
+
+    def push_task(self, task_type, payload, layer=RenderLayer.DYNAMIC):
         """
         렌더링 태스크를 등록한다 (업데이트 시 한번에 처리)
         """
 
-        self.tasks.append((task_type, payload))
+        self.tasks[layer].append((task_type, payload))
     
-    def handle_task(self, task_type, payload):
+    def handle_task(self, image, task_type, payload):
         """
         등록된 렌더링 태스크를 처리한다
         """
 
-        # 선을 선분을 그리는 작업
+        # 선을 선분을 그리는 작업 - 이미지 좌표를 화면 좌표로 옮겨 그린다
         if task_type == RenderTasks.DRAW_LINE:
-            cv2.line(self.image, payload[0], payload[1], (255, 0, 0))
+            cv2.line(image, self.to_screen_coordinates(payload[0]), self.to_screen_coordinates(payload[1]), (255, 0, 0))
         
         # 텍스트를 그리는 작업
         elif task_type == RenderTasks.WRITE_TEXT:
-            cv2.putText(self.image, payload[0], payload[1], cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2, cv2.LINE_AA)
+            cv2.putText(image, payload[0], payload[1], cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2, cv2.LINE_AA)
 
     def handle_inputs(self):
         """
@@ -73,24 +107,143 @@ class ImageRenderer:
         # 렌더링할 이미지의 종류를 바꾼다
         if input_ev == HairSEMEvents.SWITCH_IMAGE:
             self.image_type = ImageType((self.image_type.value + 1) % len(ImageType))
+            self.dirty = True
+
+        # 화면 중심을 기준으로 확대, 축소
+        elif input_ev == HairSEMEvents.ZOOM_IN:
+            self.zoom_at(ZOOM_STEP, (self.view_width / 2, self.view_height / 2))
+        elif input_ev == HairSEMEvents.ZOOM_OUT:
+            self.zoom_at(1 / ZOOM_STEP, (self.view_width / 2, self.view_height / 2))
+        elif input_ev == HairSEMEvents.RESET_VIEW:
+            self.reset_view()
+
+    def on_wheel(self, x, y, delta):
+        """마우스 휠 콜백 - 커서 위치를 기준으로 확대, 축소"""
+
+        self.zoom_at(ZOOM_STEP if delta > 0 else 1 / ZOOM_STEP, (x, y))
+
+    def on_drag(self, dx, dy):
+        """우클릭 끌기 콜백 - 화면을 옮긴다"""
+
+        self.view_x -= dx / self.zoom
+        self.view_y -= dy / self.zoom
+        self.dirty = True
+
+    def reset_view(self):
+        """이미지 전체가 화면에 들어오도록 가운데에 맞춘다"""
+
+        self.fit_zoom = min(self.view_width / self.image_width, self.view_height / self.image_height)
+        self.zoom = self.fit_zoom
+        self.view_x = (self.image_width - self.view_width / self.zoom) / 2
+        self.view_y = (self.image_height - self.view_height / self.zoom) / 2
+        self.dirty = True
+
+    def zoom_at(self, factor, screen_point):
+        """화면의 screen_point 아래에 있는 이미지 위치가 그대로 있도록 factor배 확대한다"""
+
+        image_x, image_y = self.to_image_coordinates(screen_point)
+
+        self.zoom = min(max(self.zoom * factor, self.fit_zoom / 2), MAX_ZOOM)
+        self.view_x = image_x - screen_point[0] / self.zoom
+        self.view_y = image_y - screen_point[1] / self.zoom
+        self.dirty = True
+
+    def to_image_coordinates(self, point):
+        """화면 좌표를 이미지 좌표(원본 해상도 이미지의 픽셀 좌표)로 바꾼다"""
+
+        x, y = point
+        return self.view_x + x / self.zoom, self.view_y + y / self.zoom
+
+    def to_screen_coordinates(self, point):
+        """이미지 좌표를 화면 좌표로 바꾼다"""
+
+        x, y = point
+        return int(round((x - self.view_x) * self.zoom)), int(round((y - self.view_y) * self.zoom))
+
+    def to_raw_image_coordinates(self, point):
+        """이미지 좌표를 raw_image(화면 크기로 줄인 이미지)의 픽셀 좌표로 바꾼다"""
+
+        x, y = point
+        return x * self.raw_image.shape[1] / self.image_width, y * self.raw_image.shape[0] / self.image_height
+
+    def from_raw_image_coordinates(self, point):
+        """raw_image(화면 크기로 줄인 이미지)의 픽셀 좌표를 이미지 좌표 (원본 이미지의 픽셀 좌표)로 바꾼다"""
+
+        x, y = point
+        return x * self.image_width / self.raw_image.shape[1], y * self.image_height / self.raw_image.shape[0]
+
+    def analysis_image(self):
+        """분석할 원본 해상도 이미지"""
+
+        return self.source
+
+    def close(self):
+        """백그라운드에서 만들고 있는 피라미드를 멈춘다 - 프로그램을 끝낼 때 만드는 작업이 끝나기를 기다리지 않는다"""
+
+        for pyramid in self.pyramids.values():
+            pyramid.close()
+
+    def base_image(self):
+        """
+        렌더링 종류에 따른 이미지에서 현재 화면에 보이는 부분만 합성한다 (새 배열)
+
+        피라미드의 축소 이미지가 아직 만들어지는 중이라면 화면 크기로 줄인 이미지를 대신 확대해서 보여준다
+        """
+
+        pyramid = self.pyramids[self.image_type]
+        image = pyramid.compose(self.view_x, self.view_y, self.zoom, self.view_width, self.view_height, self.image_width, self.image_height)
+
+        self.showing_preview = image is None
+        if image is not None:
+            return image
+
+        preview = self.raw_image if self.image_type == ImageType.RAW_IMAGE else self.raw_mask_image
+        scale_x, scale_y = self.image_width / preview.shape[1], self.image_height / preview.shape[0]
+        matrix = np.float32([
+            [self.zoom * scale_x, 0, -self.view_x * self.zoom],
+            [0, self.zoom * scale_y, -self.view_y * self.zoom],
+        ])
+
+        return cv2.warpAffine(preview, matrix, (self.view_width, self.view_height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
 
     def update(self):
         """
-        현재 화면을 업데이트 한다
+        현재 화면을 업데이트 한다 - 바뀐 것이 있을 때만 다시 그리며, 다시 그렸다면 True를 반환한다
         """
 
         self.handle_inputs()
 
-        # 렌더링 종류에 따라서 원본을 복사한다
-        if self.image_type == ImageType.RAW_IMAGE:
-            self.image = np.copy(self.raw_image)
+        # 피라미드가 다 만들어졌다면 미리보기 대신 다시 그린다
+        if self.showing_preview and self.pyramids[self.image_type].ready.is_set():
+            self.dirty = True
+
+        static_tasks, dynamic_tasks = self.tasks[RenderLayer.STATIC], self.tasks[RenderLayer.DYNAMIC]
+        self.tasks = {RenderLayer.STATIC: [], RenderLayer.DYNAMIC: []}
+
+        static_changed = self.dirty or static_tasks != self.rendered_tasks[RenderLayer.STATIC]
+        dynamic_changed = dynamic_tasks != self.rendered_tasks[RenderLayer.DYNAMIC]
+
+        if not static_changed and not dynamic_changed:
+            return False
+
+        # 정적 레이어는 바뀌었을 때만 (화면을 옮겼거나 확대했을 때 포함) 보이는 타일을 합성하여 다시 그린다
+        if static_changed:
+            self.static_layer = self.base_image()
+            for task_type, payload in static_tasks:
+                self.handle_task(self.static_layer, task_type, payload)
+
+        # 동적 레이어가 있을 때만 정적 레이어를 복사한다
+        if len(dynamic_tasks) > 0:
+            self.image = np.copy(self.static_layer)
+            for task_type, payload in dynamic_tasks:
+                self.handle_task(self.image, task_type, payload)
         else:
-            self.image = np.copy(self.raw_mask_image)
+            self.image = self.static_layer
+
+        self.rendered_tasks = {RenderLayer.STATIC: static_tasks, RenderLayer.DYNAMIC: dynamic_tasks}
+        self.dirty = False
 
-        # 등록된 렌더링 작업을 모두 수행한다
-        while len(self.tasks) > 0:
-            task_type, payload = self.tasks.pop(0)
-            self.handle_task(task_type, payload)
-        
         # 렌더링 후 이미지를 띄운다
         cv2.imshow('img_window', self.image)
+
+        return True
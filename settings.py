@@ -19,4 +19,39 @@ Y_SIZE = 600
 CROP_IMAGE_SIZE = 128
 BOX_SIZE = 2
 LIMIT_DATASET_LOAD = 1000
-TRAIN_TEST_RATIO = 0.3
\ No newline at end of file
+TRAIN_TEST_RATIO = 0.3
+MODEL_PATH = "sem_analysis.keras"
+INFERENCE_BATCH_SIZE = 16
+TILE_STRIDE = 96
+DATASET_DIRECTORY = "sem_cropped_images"
+DATASET_CACHE_PATH = "sem_cropped_images/tfdata-cache"
+SHUFFLE_BUFFER_SIZE = 1024
+CROP_MANIFEST_PATH = "sem_cropped_images/crops.csv"
+SHARD_DIRECTORY = "sem_cropped_images/shards"
+SHARD_SIZE = 4096
+AUTO_CROP_SAMPLES = 500
+CROP_SEED = None
+CROP_WRITER_WORKERS = 4
+SOURCE_IMAGE_DIRECTORY = "sem_images"
+STEPS_PER_EPOCH = 100
+CHECKPOINT_DIRECTORY = "models"
+CHECKPOINT_EVERY = 1
+CHECKPOINT_BEST_ONLY = True
+CHECKPOINTS_TO_KEEP = 3
+PREVIEW_EVERY = 20
+EARLY_STOPPING_PATIENCE = 20
+INFERENCE_BACKEND = "keras"
+TFLITE_MODEL_PATH = "sem_analysis.tflite"
+TFLITE_THREADS = None
+TARGET_FPS = 60
+IDLE_MAX_WAIT_MS = 500
+LOOP_STATS_INTERVAL = 1.0
+ANALYSIS_CACHE_DIRECTORY = "analysis_cache"
+ANALYSIS_CACHE_MAX_BYTES = 512 * 1024 * 1024
+STITCH_MEMMAP_PIXELS = 50_000_000
+PYRAMID_TILE_SIZE = 256
+TILE_CACHE_BYTES = 64 * 1024 * 1024
+ZOOM_STEP = 1.25
+MAX_ZOOM = 16.0
+ANALYSIS_PIPELINE = True
+PIPELINE_QUEUE_SIZE = 4
@@ -0,0 +1,99 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import csv
+import os
+import time
+import zlib
+import cv2
+import numpy as np
+
+from dataset_manager import SHARD_INDEX_FIELDS, SHARD_INDEX_FILE, ImageType, load_crop_manifest, load_image_paths, shard_file_paths
+from tiling import pad_to_tile
+from settings import CROP_IMAGE_SIZE, CROP_MANIFEST_PATH, DATASET_DIRECTORY, SHARD_DIRECTORY, SHARD_SIZE, TRAIN_TEST_RATIO
+
+def assign_split(file_name, ratio=TRAIN_TEST_RATIO):
+    """파일 이름의 해시로 split을 정한다 - 다시 pack해도 같은 샘플은 같은 split에 들어간다"""
+
+    return "test" if zlib.crc32(file_name.encode()) % 1000 < ratio * 1000 else "train"
+
+def pack_dataset(dataset_directory=DATASET_DIRECTORY, shard_directory=SHARD_DIRECTORY, shard_size=SHARD_SIZE, manifest_path=None):
+    """
+    crop한 이미지와 마스크를 연속된 .npy shard로 묶고, 샘플별 index를 저장한다
+
+    이미지는 (N, 128, 128, 3), 마스크는 (N, 128, 128) uint8 배열로 저장되어 ShardDataset에서 메모리 매핑으로 읽힌다.
+    이미지 가장자리에서 crop하여 128x128보다 작은 샘플은 가장자리 픽셀을 반복하여 채운다.
+    manifest_path가 주어지지 않으면 dataset_directory 안의 crop 기록을 읽는다.
+    """
+
+    if manifest_path is None:
+        manifest_path = os.path.join(dataset_directory, os.path.basename(CROP_MANIFEST_PATH))
+
+    image_paths, mask_paths = load_image_paths(dataset_directory, ImageType.IMAGE.value + ImageType.MASK.value)
+    manifest = load_crop_manifest(manifest_path)
+
+    os.makedirs(shard_directory, exist_ok=True)
+    start = time.perf_counter()
+    rows = []
+
+    for shard, first in enumerate(range(0, len(image_paths), shard_size)):
+        shard_image_paths = image_paths[first:first + shard_size]
+        shard_mask_paths = mask_paths[first:first + shard_size]
+        n = len(shard_image_paths)
+
+        image_path, mask_path = shard_file_paths(shard_directory, shard)
+        images = np.lib.format.open_memmap(image_path, mode="w+", dtype="uint8", shape=(n, CROP_IMAGE_SIZE, CROP_IMAGE_SIZE, 3))
+        masks = np.lib.format.open_memmap(mask_path, mode="w+", dtype="uint8", shape=(n, CROP_IMAGE_SIZE, CROP_IMAGE_SIZE))
+
+        for offset, (sample_image_path, sample_mask_path) in enumerate(zip(shard_image_paths, shard_mask_paths)):
+            image = cv2.imread(str(sample_image_path))
+            mask = cv2.imread(str(sample_mask_path), cv2.IMREAD_GRAYSCALE)
+            if image is None or mask is None:
+                raise ValueError(f"could not read {sample_image_path} or its mask")
+
+            images[offset] = pad_to_tile(image, CROP_IMAGE_SIZE)
+            masks[offset] = pad_to_tile(mask, CROP_IMAGE_SIZE)
+
+            file_name = os.path.basename(str(sample_image_path))
+            source, x, y = manifest.get(file_name, ("", -1, -1))
+            rows.append([shard, offset, file_name, source, x, y, assign_split(file_name)])
+
+        images.flush()
+        masks.flush()
+        del images, masks
+
+    with open(os.path.join(shard_directory, SHARD_INDEX_FILE), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(SHARD_INDEX_FIELDS)
+        writer.writerows(rows)
+
+    print(f"packed {len(rows)} samples into {shard_directory} in {time.perf_counter() - start:.1f}s")
+
+    return len(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="crop한 데이터셋을 메모리 매핑 가능한 shard로 묶는다")
+    parser.add_argument("--dataset", default=DATASET_DIRECTORY, help="crop한 데이터셋 디렉토리")
+    parser.add_argument("--output", default=SHARD_DIRECTORY, help="shard를 저장할 디렉토리")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="shard 하나에 담을 샘플 수")
+    parser.add_argument("--manifest", default=None, help="crop 기록 CSV (기본값: 데이터셋 디렉토리의 crops.csv)")
+    args = parser.parse_args(argv)
+
+    pack_dataset(args.dataset, args.output, args.shard_size, args.manifest)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import time
+import cv2
+import numpy as np
+
+from dataset_manager import ImageType, load_image_paths
+from inference_session import InferenceSession, TFLiteSession
+import mask_analysis
+from settings import DATASET_DIRECTORY, MODEL_PATH, TFLITE_MODEL_PATH
+
+QUANTIZATIONS = ["float32", "float16", "int8"]
+
+def load_sample_images(n_samples, seed=0, dataset_directory=DATASET_DIRECTORY):
+    """crop한 데이터셋에서 무작위로 n_samples개의 이미지를 추론 입력과 같은 형태(0~255 BGR)로 읽는다"""
+
+    image_paths = load_image_paths(dataset_directory, ImageType.IMAGE.value)[0]
+    chosen = np.random.default_rng(seed).permutation(len(image_paths))[:n_samples]
+
+    return np.stack([cv2.imread(str(image_paths[i])) for i in chosen])
+
+def convert(model_path=MODEL_PATH, output_path=TFLITE_MODEL_PATH, quantization="float16", calibration_images=None):
+    """
+    Keras 모델을 TFLite 모델로 변환하여 저장한다
+
+    float16은 가중치만 반정밀도로, int8은 calibration_images로 활성값의 범위를 측정하여 정수로 양자화한다.
+    입출력은 float32로 유지되므로 TFLiteSession에서 그대로 사용할 수 있다.
+    """
+
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(model_path))
+
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if calibration_images is None or len(calibration_images) == 0:
+            raise ValueError("int8 quantization needs calibration images")
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([image[np.newaxis].astype("float32")] for image in calibration_images)
+    elif quantization != "float32":
+        raise ValueError(f"unknown quantization: {quantization}")
+
+    with open(output_path, "wb") as f:
+        f.write(converter.convert())
+
+def check_accuracy(reference_session, session, images):
+    """
+    두 세션의 예측 마스크를 비교한다
+
+    후처리한 마스크의 픽셀 일치율, 군집 픽셀의 IoU, 정규화한 예측의 평균 절대 오차, 각 세션의 처리량(images/s)을 반환한다
+    """
+
+    def timed_predict(target):
+        start = time.perf_counter()
+        predicts = target.predict(images)
+        return predicts, len(images) / (time.perf_counter() - start)
+
+    reference_predicts, reference_throughput = timed_predict(reference_session)
+    predicts, throughput = timed_predict(session)
+
+    reference_masks = mask_analysis.postprocess_predictions(reference_predicts) != 0
+    masks = mask_analysis.postprocess_predictions(predicts) != 0
+
+    union = np.logical_or(reference_masks, masks).sum()
+    intersection = np.logical_and(reference_masks, masks).sum()
+
+    return {
+        "pixel_agreement": float(np.mean(reference_masks == masks)),
+        "iou": float(intersection / union) if union > 0 else 1.0,
+        "mean_abs_error": float(np.mean(np.abs(mask_analysis.normalize_predictions(reference_predicts) - mask_analysis.normalize_predictions(predicts)))),
+        "reference_throughput": reference_throughput,
+        "throughput": throughput,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="분석 모델을 TFLite로 변환하고 Keras 모델과 정확도를 비교한다")
+    parser.add_argument("--model", default=MODEL_PATH, help="Keras 모델 경로")
+    parser.add_argument("--output", default=TFLITE_MODEL_PATH, help="저장할 TFLite 모델 경로")
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default="float16")
+    parser.add_argument("--calibration-samples", type=int, default=200, help="int8 양자화에 사용할 이미지 수")
+    parser.add_argument("--check-samples", type=int, default=64, help="정확도 비교에 사용할 이미지 수 (0이면 비교하지 않는다)")
+    args = parser.parse_args(argv)
+
+    # 보정용 이미지와 비교용 이미지는 겹치지 않게 뽑는다
+    samples = load_sample_images(args.calibration_samples + args.check_samples)
+    calibration_images, check_images = samples[:args.calibration_samples], samples[args.calibration_samples:]
+
+    convert(args.model, args.output, args.quantization, calibration_images)
+    print(f"saved {args.quantization} model to {args.output}")
+
+    if len(check_images) > 0:
+        report = check_accuracy(InferenceSession(args.model), TFLiteSession(args.output), check_images)
+        print(", ".join(f"{key}: {value:.4f}" for key, value in report.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+import tempfile
+import numpy as np
+
+from settings import CROP_IMAGE_SIZE, TILE_STRIDE
+
+def tile_origins(length, tile_size=CROP_IMAGE_SIZE, stride=TILE_STRIDE):
+    """
+    한 축을 빠짐없이 덮는 타일 시작 위치 목록 - 마지막 타일은 끝에 맞춘다
+
+    stride가 tile_size보다 크면 타일 사이에 덮이지 않는 행, 열이 생기므로 0 < stride <= tile_size가 아니라면 ValueError
+    """
+
+    if not 0 < stride <= tile_size:
+        raise ValueError(f"the tile stride must be between 1 and {tile_size}, got {stride}")
+
+    if length <= tile_size:
+        return [0]
+
+    origins = list(range(0, length - tile_size + 1, stride))
+
+    # 남는 가장자리가 있다면 끝에 맞춘 타일을 하나 더 추가
+    if origins[-1] + tile_size < length:
+        origins.append(length - tile_size)
+
+    return origins
+
+def tile_positions(height, width, tile_size=CROP_IMAGE_SIZE, stride=TILE_STRIDE):
+    """이미지 전체를 덮는 타일들의 (x, y) 시작 위치 목록"""
+
+    return [(x, y) for y in tile_origins(height, tile_size, stride) for x in tile_origins(width, tile_size, stride)]
+
+def random_shuffle_mask(raw_image):
+    """무작위로 3x3 구멍을 만든다"""
+
+    for i in range(10):
+        random_x = random.randint(1, 126)
+        random_y = random.randint(1, 126)
+
+        for x_offset in range(3):
+            for y_offset in range(3):
+                raw_image[random_y + y_offset - 1, random_x + x_offset - 1] = 0
+    
+    return raw_image
+
+def pad_to_tile(image: np.ndarray, tile_size=CROP_IMAGE_SIZE):
+    """타일보다 작은 축은 가장자리 픽셀을 반복하여 타일 크기까지 채운다"""
+
+    pad_y = max(0, tile_size - image.shape[0])
+    pad_x = max(0, tile_size - image.shape[1])
+
+    if pad_y == 0 and pad_x == 0:
+        return image
+
+    padding = [(0, pad_y), (0, pad_x)] + [(0, 0)] * (image.ndim - 2)
+    return np.pad(image, padding, mode="edge")
+
+def extract_tiles(image: np.ndarray, tile_size=CROP_IMAGE_SIZE, stride=TILE_STRIDE):
+    """
+    이미지 전체를 겹치는 타일로 나눈다
+
+    (N, tile_size, tile_size, C) 타일 배열과 각 타일의 (x, y) 시작 위치 목록을 반환한다
+    """
+
+    padded = pad_to_tile(image, tile_size)
+    positions = tile_positions(padded.shape[0], padded.shape[1], tile_size, stride)
+
+    tiles = np.stack([padded[y:y + tile_size, x:x + tile_size] for x, y in positions])
+
+    return tiles, positions
+
+def blending_weights(tile_size=CROP_IMAGE_SIZE):
+    """타일 중심에서 가장 크고 가장자리로 갈수록 작아지는 (tile_size, tile_size) 가중치"""
+
+    ramp = np.minimum(np.arange(1, tile_size + 1), np.arange(tile_size, 0, -1)).astype("float32")
+
+    return np.outer(ramp, ramp)
+
+def read_tiles(source, positions, tile_size=CROP_IMAGE_SIZE):
+    """ImageSource에서 주어진 (x, y) 위치의 타일만 읽어 (N, tile_size, tile_size, 3) 배열로 반환 (이미지보다 큰 부분은 가장자리로 채운다)"""
+
+    return np.stack([pad_to_tile(source.read_region(x, y, tile_size, tile_size), tile_size) for x, y in positions])
+
+class TileStitcher:
+    """
+    타일별 예측을 가중 평균으로 합치는 누적기 - 타일을 한 배치씩 add하면 되므로 모든 타일을 메모리에 둘 필요가 없다
+
+    directory가 주어지면 누적 배열을 그 디렉토리의 임시 파일에 메모리 매핑하므로, 아주 큰 이미지도 이어붙일 수 있다
+    """
+
+    def __init__(self, height, width, channels, tile_size=CROP_IMAGE_SIZE, directory=None):
+        self.height, self.width = height, width
+        self.tile_size = tile_size
+        self.weights = blending_weights(tile_size)
+        self.files = []
+
+        padded_height, padded_width = max(height, tile_size), max(width, tile_size)
+        self.stitched = self.allocate((padded_height, padded_width, channels), directory)
+        self.total_weights = self.allocate((padded_height, padded_width), directory)
+
+    def allocate(self, shape, directory):
+        if directory is None:
+            return np.zeros(shape, dtype="float32")
+
+        # 이름 없는 임시 파일이므로 누적기가 사라지면 파일도 지워진다
+        file = tempfile.TemporaryFile(dir=directory, suffix=".stitch")
+        self.files.append(file)
+
+        return np.memmap(file, dtype="float32", mode="w+", shape=shape)
+
+    def add(self, tiles, positions):
+        """(N, tile_size, tile_size, C) 타일과 (x, y) 시작 위치들을 누적한다"""
+
+        tile_size = self.tile_size
+
+        for tile, (x, y) in zip(tiles, positions):
+            self.stitched[y:y + tile_size, x:x + tile_size] += tile * self.weights[:, :, np.newaxis]
+            self.total_weights[y:y + tile_size, x:x + tile_size] += self.weights
+
+    def rows(self, start, stop):
+        """누적이 끝난 뒤 start행부터 stop행까지의 가중 평균 (stop - start, width, C)"""
+
+        return self.stitched[start:stop, :self.width] / self.total_weights[start:stop, :self.width, np.newaxis]
+
+    def result(self):
+        """가중 평균한 (height, width, C) 전체 이미지"""
+
+        return self.rows(0, self.height)
+
+class RowStitcher:
+    """
+    위에서부터 행 단위로 타일을 이어붙이는 누적기 - 타일 한 줄 높이만큼의 행만 메모리에 둔다
+
+    타일은 tile_positions 순서(위에서 아래, 왼쪽에서 오른쪽)로 add해야 하며, 어떤 행보다 위에서 시작하는 타일이
+    모두 더해졌다면 take로 그 행까지의 가중 평균을 꺼낼 수 있다. 꺼낸 행은 버퍼에서 지워진다.
+    """
+
+    def __init__(self, height, width, channels, tile_size=CROP_IMAGE_SIZE):
+        self.height, self.width = height, width
+        self.tile_size = tile_size
+        self.weights = blending_weights(tile_size)
+        self.offset = 0  # 버퍼의 첫 행이 이미지의 몇번째 행인지
+
+        padded_width = max(width, tile_size)
+        self.stitched = np.zeros((tile_size, padded_width, channels), dtype="float32")
+        self.total_weights = np.zeros((tile_size, padded_width), dtype="float32")
+
+    def add(self, tile, x, y):
+        top = y - self.offset
+        if top < 0:
+            raise ValueError("tiles must be added from top to bottom")
+
+        size = self.tile_size
+        self.stitched[top:top + size, x:x + size] += tile * self.weights[:, :, np.newaxis]
+        self.total_weights[top:top + size, x:x + size] += self.weights
+
+    def take(self, stop):
+        """offset행부터 stop행 전까지의 가중 평균을 꺼내고 버퍼를 위로 옮긴다 (stop - offset은 tile_size 이하)"""
+
+        start, n = self.offset, stop - self.offset
+        rows = self.stitched[:n, :self.width] / self.total_weights[:n, :self.width, np.newaxis]
+
+        # 남은 행을 위로 옮기고 빈 행은 0으로 채운다
+        self.stitched[:self.tile_size - n] = self.stitched[n:].copy()
+        self.stitched[self.tile_size - n:] = 0
+        self.total_weights[:self.tile_size - n] = self.total_weights[n:].copy()
+        self.total_weights[self.tile_size - n:] = 0
+        self.offset = stop
+
+        # 타일보다 작은 이미지를 채운 행은 버린다
+        return rows[:max(0, self.height - start)]
+
+def stitch_tiles(tiles: np.ndarray, positions, height, width):
+    """
+    타일별 예측을 가중 평균으로 합쳐서 (height, width, C) 전체 이미지로 되돌린다
+
+    겹치는 영역은 blending_weights로 섞으므로 타일 경계에서 값이 끊기지 않는다
+    """
+
+    stitcher = TileStitcher(height, width, tiles.shape[3], tiles.shape[1])
+    stitcher.add(tiles, positions)
+
+    return stitcher.result()
@@ -0,0 +1,191 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import atexit
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import threading
+import time
+
+# HAIRSEM_TRACE=1 이면 hairsem-trace.json에, HAIRSEM_TRACE=경로 이면 그 경로에 프로그램 종료 시 기록을 저장한다
+TRACE_ENVIRONMENT_VARIABLE = "HAIRSEM_TRACE"
+DEFAULT_TRACE_PATH = "hairsem-trace.json"
+
+class _NullSpan:
+    """기록이 꺼져 있을 때 쓰는 아무것도 하지 않는 구간 - 하나만 만들어 재사용한다"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Span:
+    """이름, 시작 시각, 걸린 시간, 추가 정보(타일 수, 군집 수, 바이트 수 등)를 기록하는 구간"""
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.depth = self.tracer.push()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter() - self.start
+        self.tracer.pop(self)
+        return False
+
+    def set(self, **args):
+        """구간의 추가 정보를 기록한다"""
+
+        self.args.update(args)
+
+class Tracer:
+    """
+    분석 단계별 구간을 모아 Chrome trace (chrome://tracing, Perfetto) 형식으로 내보내는 기록기
+
+    가장 바깥쪽 구간이 끝날 때마다 그 안의 단계별 시간을 한 줄로 요약해 둔다
+    """
+
+    def __init__(self):
+        self.events = []
+        self.depths = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.last_summary = None
+
+    def push(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+
+        stack.append(len(self.events))
+        return len(stack) - 1
+
+    def pop(self, span):
+        first_child = self.local.stack.pop()
+
+        event = {
+            "name": span.name,
+            "cat": "hairsem",
+            "ph": "X",
+            "ts": (span.start - self.origin) * 1e6,
+            "dur": span.duration * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": span.args,
+        }
+
+        with self.lock:
+            # 요약에는 바로 안쪽 구간만 더한다 (더 안쪽 구간은 바깥 구간에 이미 포함되어 있다)
+            children = [child for child, depth in zip(self.events[first_child:], self.depths[first_child:]) if child["tid"] == event["tid"] and depth == span.depth + 1]
+            self.events.append(event)
+            self.depths.append(span.depth)
+
+        if span.depth == 0:
+            self.last_summary = summarize(event, children)
+
+    def clear(self):
+        with self.lock:
+            self.events, self.depths = [], []
+
+    def export(self, path):
+        """지금까지의 구간을 Chrome trace JSON 파일로 저장한다"""
+
+        with self.lock:
+            events = list(self.events)
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def summarize(root, children):
+    """가장 바깥쪽 구간과 그 안의 단계별 시간을 한 줄로 요약한다"""
+
+    totals = {}
+    for child in children:
+        totals[child["name"]] = totals.get(child["name"], 0.0) + child["dur"]
+
+    stages = ", ".join(f"{name} {duration / 1000:.0f}ms" for name, duration in totals.items())
+
+    return f"{root['name']} {root['dur'] / 1000:.0f}ms ({stages})" if stages else f"{root['name']} {root['dur'] / 1000:.0f}ms"
+
+def trace_path():
+    """환경 변수로 정한 저장 경로 - 작업 프로세스라면 파일 이름에 프로세스 번호를 붙인다"""
+
+    value = os.environ.get(TRACE_ENVIRONMENT_VARIABLE, "")
+    path = DEFAULT_TRACE_PATH if value.lower() in ("1", "true", "yes", "on") else value
+
+    if multiprocessing.parent_process() is not None:
+        root, extension = os.path.splitext(path)
+        path = f"{root}-{os.getpid()}{extension}"
+
+    return path
+
+_tracer = Tracer() if os.environ.get(TRACE_ENVIRONMENT_VARIABLE, "").lower() not in ("", "0", "false", "no", "off") else None
+
+if _tracer is not None:
+    atexit.register(lambda: _tracer.export(trace_path()))
+
+def initialize_worker():
+    """
+    작업 프로세스(ProcessPoolExecutor 등)의 초기화 함수에서 호출한다
+
+    작업 프로세스는 os._exit로 끝나므로 atexit이 실행되지 않는다. 대신 multiprocessing의 종료 처리기에 저장을 등록하여
+    프로세스 번호를 붙인 파일로 저장한다. fork로 물려받은 부모 프로세스의 기록은 지운다.
+    """
+
+    if _tracer is None or multiprocessing.parent_process() is None:
+        return
+
+    _tracer.clear()
+    multiprocessing.util.Finalize(None, lambda: _tracer.export(trace_path()), exitpriority=10)
+
+def enabled():
+    return _tracer is not None
+
+def span(name, **args):
+    """
+    구간을 기록하는 with 문 객체를 반환한다 - 기록이 꺼져 있다면 아무것도 하지 않는 객체를 반환한다
+
+        with tracing.span("inference", tiles=len(tiles)) as s:
+            ...
+            s.set(nbytes=predicts.nbytes)
+    """
+
+    if _tracer is None:
+        return _NULL_SPAN
+
+    return Span(_tracer, name, args)
+
+def last_summary():
+    """가장 최근에 끝난 가장 바깥쪽 구간의 한 줄 요약 (기록이 꺼져 있거나 아직 없다면 None)"""
+
+    return _tracer.last_summary if _tracer is not None else None
+
+def export(path):
+    if _tracer is not None:
+        _tracer.export(path)
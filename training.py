@@ -0,0 +1,264 @@
+#    hairSEM aims to quantify hair damage using a SEM image
+#    Copyright (C) 2024 dolphin2410
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+#   Portions of this code are licensed under the Apache License, Version 2.0. 
+#   See the LICENSE-APACHE file for details.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import cv2
+from matplotlib.figure import Figure
+import numpy as np
+import tensorflow as tf
+from dataset_manager import RandomCropSampler, ShardDataset, load_source_images, load_streaming_dataset, normalize_image, split_data_with_ratio
+from ml_model import unet_model
+import mask_analysis
+from settings import CHECKPOINT_BEST_ONLY, CHECKPOINT_DIRECTORY, CHECKPOINT_EVERY, CHECKPOINTS_TO_KEEP, EARLY_STOPPING_PATIENCE, PREVIEW_EVERY, SHARD_DIRECTORY, SOURCE_IMAGE_DIRECTORY, STEPS_PER_EPOCH, TRAIN_TEST_RATIO
+
+# Source code from Tensorflow docs - start
+
+class DisplayCallback(tf.keras.callbacks.Callback):
+    """every epoch 간격으로 샘플 예측을 그림 파일로 저장한다 - 그림은 백그라운드 스레드에서 그리므로 학습이 멈추지 않는다"""
+
+    def __init__(self, sample_image, sample_mask, directory=CHECKPOINT_DIRECTORY, every=PREVIEW_EVERY):
+        super().__init__()
+        self.sample_image = sample_image
+        self.sample_mask = sample_mask
+        self.directory = directory
+        self.every = every
+        self.writer = BackgroundWriter()
+
+    def on_train_begin(self, logs=None):
+        self.writer.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every != 0:
+            return
+
+        predicted = np.array(self.model(np.array([self.sample_image]), training=False)[0])
+        display_list = [self.sample_image, self.sample_mask * 255, mask_analysis.coerce_image(predicted)]
+
+        self.writer.submit(save_preview, os.path.join(self.directory, f"preview-epoch{epoch + 1:04d}.png"), display_list)
+
+        print(f'\nSample Prediction after epoch {epoch + 1}\n')
+
+    def on_train_end(self, logs=None):
+        self.writer.finish()
+
+def save_preview(path, display_list):
+    """입력 이미지, 정답 마스크, 예측 마스크를 나란히 그려 저장한다 (pyplot을 쓰지 않으므로 어느 스레드에서나 호출할 수 있다)"""
+
+    title = ['Input Image', 'True Mask', 'Predicted Mask']
+    figure = Figure(figsize=(15, 5))
+
+    for i in range(3):
+        axis = figure.add_subplot(1, 3, i+1)
+        axis.set_title(title[i])
+        figure.colorbar(axis.imshow(display_list[i]), ax=axis)
+        axis.axis('off')
+
+    figure.savefig(path)
+
+# end
+
+class BackgroundWriter:
+    """
+    콜백의 파일 저장을 백그라운드 스레드 하나에서 순서대로 처리하는 도우미
+
+    스레드 풀은 학습이 시작될 때(start) 만들고 끝날 때(finish) 닫으므로, 같은 콜백으로 fit을 여러 번 해도 된다.
+    저장 중에 발생한 예외는 다음 submit이나 finish에서 다시 발생한다.
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.futures = []
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, function, *args):
+        self.check()
+        self.start()
+        self.futures.append(self.executor.submit(function, *args))
+
+    def check(self):
+        """끝난 저장 작업을 정리하고, 실패했다면 그 예외를 발생시킨다"""
+
+        done = [future for future in self.futures if future.done()]
+        self.futures = [future for future in self.futures if not future.done()]
+
+        for future in done:
+            future.result()
+
+    def finish(self):
+        """남은 저장을 모두 기다린 뒤 스레드 풀을 닫는다"""
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        self.check()
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    """
+    가중치를 복사만 하고 파일 저장은 백그라운드 스레드에서 하는 체크포인트 콜백
+
+    every epoch 간격으로 저장하며, best_only가 True라면 monitor 값이 좋아졌을 때만 저장한다.
+    가장 최근의 keep개 체크포인트만 남기며, 체크포인트는 load_checkpoint로 다시 불러올 수 있다.
+    """
+
+    def __init__(self, directory=CHECKPOINT_DIRECTORY, every=CHECKPOINT_EVERY, best_only=CHECKPOINT_BEST_ONLY, keep=CHECKPOINTS_TO_KEEP, monitor="val_loss"):
+        super().__init__()
+        self.directory = directory
+        self.every = every
+        self.best_only = best_only
+        self.keep = keep
+        self.monitor = monitor
+        self.best = math.inf
+        self.saved_paths = []
+        self.writer = BackgroundWriter()
+
+    def on_train_begin(self, logs=None):
+        self.writer.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every != 0:
+            return
+
+        if self.best_only:
+            current = (logs or {}).get(self.monitor)
+            if current is None or current >= self.best:
+                return
+            self.best = current
+
+        # get_weights는 가중치의 복사본을 반환하므로 학습이 계속되어도 안전하다
+        weights = self.model.get_weights()
+        path = os.path.join(self.directory, f"epoch{epoch + 1:04d}.weights.npz")
+
+        self.writer.submit(self.write, path, weights)
+
+    def write(self, path, weights):
+        np.savez(path, *weights)
+        self.saved_paths.append(path)
+
+        # 오래된 체크포인트 정리
+        while len(self.saved_paths) > self.keep:
+            os.remove(self.saved_paths.pop(0))
+
+    def on_train_end(self, logs=None):
+        self.writer.finish()
+
+def load_checkpoint(path):
+    """AsyncCheckpoint로 저장한 가중치로 모델을 만든다 - model.save(MODEL_PATH)로 분석용 모델을 만들 수 있다"""
+
+    model = unet_model()
+
+    with np.load(path) as weights:
+        model.set_weights([weights[f"arr_{i}"] for i in range(len(weights.files))])
+
+    return model
+
+def build_callbacks(sample_image, sample_mask, checkpoint_every=CHECKPOINT_EVERY, best_only=CHECKPOINT_BEST_ONLY, patience=EARLY_STOPPING_PATIENCE, directory=CHECKPOINT_DIRECTORY):
+    """체크포인트, 미리보기, 지표 기록, 조기 종료 콜백을 만든다 (patience가 0이라면 조기 종료하지 않는다)"""
+
+    os.makedirs(directory, exist_ok=True)
+
+    callbacks = [
+        AsyncCheckpoint(directory, checkpoint_every, best_only),
+        DisplayCallback(sample_image, sample_mask, directory),
+        tf.keras.callbacks.CSVLogger(os.path.join(directory, "training_log.csv")),
+    ]
+
+    if patience > 0:
+        callbacks.append(tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=patience, restore_best_weights=True))
+
+    return callbacks
+
+def load_random_crop_dataset(batch_size=64, validation_size=256):
+    """
+    원본 SEM 이미지에서 매 배치마다 무작위로 crop하는 학습 데이터와, 고정된 검증 데이터를 만든다
+
+    원본 이미지가 두 장 이상이라면 TRAIN_TEST_RATIO만큼의 원본 이미지를 검증용으로 떼어 둔다
+    """
+
+    images, masks = load_source_images()
+    test_images, train_images = split_data_with_ratio(images, TRAIN_TEST_RATIO) if len(images) > 1 else (images, images)
+    test_masks, train_masks = split_data_with_ratio(masks, TRAIN_TEST_RATIO) if len(masks) > 1 else (masks, masks)
+
+    train_sampler = RandomCropSampler(train_images, train_masks)
+    test_dataset = RandomCropSampler(test_images, test_masks, augment=False, seed=0).sample(validation_size)
+
+    return test_dataset, train_sampler.as_tf_dataset(batch_size)
+
+def load_shard_dataset(batch_size=64, shard_directory=SHARD_DIRECTORY):
+    """
+    shard_packer로 묶은 shard에서 (검증 데이터, 학습 데이터, 미리보기용 (이미지, 마스크))를 만든다
+
+    split은 shard_packer가 정해둔 것을 그대로 사용한다
+    """
+
+    test_shards, train_shards = ShardDataset(shard_directory, "test"), ShardDataset(shard_directory, "train")
+    sample_image, sample_mask = train_shards[min(2, len(train_shards) - 1)]
+
+    sample = normalize_image(np.array(sample_image)), np.repeat(sample_mask[:, :, np.newaxis], 3, axis=2)
+
+    return test_shards.as_tf_dataset(batch_size, shuffle=False), train_shards.as_tf_dataset(batch_size), sample
+
+def train_model(epochs=200, batch_size=64, random_crops=False, steps_per_epoch=STEPS_PER_EPOCH, checkpoint_every=CHECKPOINT_EVERY, best_only=CHECKPOINT_BEST_ONLY, patience=EARLY_STOPPING_PATIENCE, shards=False):
+    """
+    데이터셋을 스트리밍으로 불러와 모델을 학습시켜서 반환
+
+    random_crops가 True라면 crop한 데이터셋 대신 원본 SEM 이미지에서 매 배치마다 무작위로 crop하여 학습하고,
+    shards가 True라면 crop한 JPEG 파일 대신 shard_packer로 묶은 shard에서 읽는다
+    """
+
+    # 데이터셋은 학습할 때만, 배치 단위로 불러온다
+    if random_crops:
+        test_dataset, train_dataset = load_random_crop_dataset(batch_size)
+        sample_image, sample_mask = test_dataset[0][2], test_dataset[1][2]
+    elif shards:
+        test_dataset, train_dataset, (sample_image, sample_mask) = load_shard_dataset(batch_size)
+        steps_per_epoch = None
+    else:
+        test_dataset, train_dataset, (train_image_paths, train_mask_paths) = load_streaming_dataset(batch_size)
+        sample_image = normalize_image(cv2.imread(str(train_image_paths[2])))
+        sample_mask = cv2.imread(str(train_mask_paths[2]))
+        steps_per_epoch = None
+
+    model = unet_model()
+    model.compile(optimizer='adam',
+                loss=tf.keras.losses.CategoricalCrossentropy(from_logits=True),
+                metrics=['accuracy'])
+
+    model.fit(train_dataset, epochs=epochs, steps_per_epoch=steps_per_epoch, validation_data=test_dataset, callbacks=build_callbacks(sample_image, sample_mask, checkpoint_every, best_only, patience))
+    return model
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SEM 이미지 분할 모델을 학습한다")
+    parser.add_argument("--epochs", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--random-crops", action="store_true", help=f"{SOURCE_IMAGE_DIRECTORY}의 원본 이미지에서 매 배치마다 무작위로 crop하여 학습한다")
+    parser.add_argument("--shards", action="store_true", help=f"crop한 이미지 대신 shard_packer로 {SHARD_DIRECTORY}에 묶은 shard에서 학습 데이터를 읽는다")
+    parser.add_argument("--steps-per-epoch", type=int, default=STEPS_PER_EPOCH, help="--random-crops를 사용할 때 한 epoch의 배치 수")
+    parser.add_argument("--checkpoint-every", type=int, default=CHECKPOINT_EVERY, help="체크포인트를 확인하는 epoch 간격")
+    parser.add_argument("--save-all", action="store_true", help="검증 손실이 좋아지지 않아도 체크포인트를 저장한다")
+    parser.add_argument("--patience", type=int, default=EARLY_STOPPING_PATIENCE, help="조기 종료 patience (0이면 사용하지 않는다)")
+    args = parser.parse_args()
+
+    train_model(args.epochs, args.batch_size, args.random_crops, args.steps_per_epoch, args.checkpoint_every, not args.save_all, args.patience, args.shards)